@@ -14,12 +14,32 @@
 9. 循环直到完成
 """
 
+import os
+import csv
+import json
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import time
 import math
 import shutil
+import asyncio
+import bisect
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
 from pathlib import Path
-from typing import Optional, Tuple
+from typing import Dict, List, Optional, Tuple
+
+try:
+    import aiohttp  # type: ignore
+except Exception:
+    aiohttp = None  # optional: 没有aiohttp时逐个同步获取
+
+try:
+    import orjson  # type: ignore
+    _json_loads = orjson.loads
+except Exception:
+    _json_loads = json.loads  # optional: 没有orjson时使用标准库
 
 # 配置
 BASE_URL = "http://127.0.0.1:8000"
@@ -30,6 +50,19 @@ SCRIPT_DIR = Path(__file__).parent
 LABELS_DIR = SCRIPT_DIR / "labels"
 SHOTS_DIR = LABELS_DIR / "shots"  # 服务器保存截图的目录
 SCREENSHOTS_DIR = LABELS_DIR / "screenshots"  # 我们按序号保存的截图目录
+# 截图目录的字符串前缀（逐格网拼接文件名时避免反复构造 Path 对象）
+SHOTS_PREFIX = os.path.join(str(SHOTS_DIR), "")
+SCREENSHOTS_PREFIX = os.path.join(str(SCREENSHOTS_DIR), "")
+
+# 流量变化阈值表：2021年日总量落在 (bins[i-1], bins[i]] 区间时阈值为 vals[i]
+# 小流量(<=100):200, 中小(<=200):250, 中等(<=500):400, 中大(<=1000):700, 大(<=2000):900, 超大:1000
+FLOW_THRESHOLD_BINS = (100, 200, 500, 1000, 2000)
+FLOW_THRESHOLD_VALS = (200, 250, 400, 700, 900, 1000)
+
+# 并发预取小时数据的连接数
+PREFETCH_CONCURRENCY = 8
+# 未能批量预取时，后台线程提前获取后续格网数据的数量
+PIPELINE_WORKERS = 4
 
 # 确保目录存在
 SCREENSHOTS_DIR.mkdir(parents=True, exist_ok=True)
@@ -47,9 +80,21 @@ class AutoLabeler:
         self.base_url = base_url
         self.api_base = f"{base_url}/api"
         self.session = requests.Session()
+        # 连接池复用长连接；对网关类错误做少量退避重试（默认只重试GET，不会重复提交标签）
+        adapter = HTTPAdapter(
+            pool_connections=16,
+            pool_maxsize=32,
+            max_retries=Retry(total=3, backoff_factor=0.2, status_forcelist=[502, 503, 504]),
+        )
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.session.headers.update({"Accept-Encoding": "gzip, deflate", "Connection": "keep-alive"})
+        # 服务器是否支持 POST /api/label 携带 advance 标志（None=未知，首次调用时探测）
+        self._label_advance_supported: Optional[bool] = None
 
         # 加载椭圆数据（用于空间模式判断）
         self.ellipses_data = None
+        self._ellipse_area_index: Dict[Tuple[int, int], float] = {}  # (year, grid_id) -> 椭圆面积
         if ellipses_path is None:
             # 默认路径
             script_dir = Path(__file__).parent
@@ -57,9 +102,9 @@ class AutoLabeler:
 
         if ellipses_path and Path(ellipses_path).exists():
             try:
-                import json
-                with open(ellipses_path, 'r') as f:
-                    self.ellipses_data = json.load(f)
+                with open(ellipses_path, 'rb') as f:
+                    self.ellipses_data = _json_loads(f.read())
+                self._ellipse_area_index = self._build_ellipse_index(self.ellipses_data)
                 print(f"[已加载椭圆数据: {ellipses_path}]")
             except Exception as e:
                 print(f"[警告] 加载椭圆数据失败: {e}")
@@ -76,7 +121,7 @@ class AutoLabeler:
             raise ValueError(f"Unsupported method: {method}")
 
         resp.raise_for_status()
-        return resp.json()
+        return _json_loads(resp.content)
 
     def get_queue(self) -> dict:
         """获取当前标注队列"""
@@ -86,9 +131,35 @@ class AutoLabeler:
         """获取格网24小时数据"""
         return self.fetch_json(f"hourly?grid_id={grid_id}")
 
-    def get_grid_flows(self, grid_id: int, year: str = "all") -> dict:
-        """获取格网流量数据"""
-        return self.fetch_json(f"flows?grid_id={grid_id}&year={year}&direction=both&topk=100")
+    async def _fetch_hourly_async(self, session, sem: asyncio.Semaphore, grid_id: int) -> Tuple[int, Optional[dict]]:
+        """异步获取单个格网的24小时数据（失败返回None，后续同步重试）"""
+        url = f"{self.api_base}/hourly?grid_id={grid_id}"
+        async with sem:
+            try:
+                async with session.get(url) as resp:
+                    if resp.status != 200:
+                        return grid_id, None
+                    return grid_id, _json_loads(await resp.read())
+            except Exception:
+                return grid_id, None
+
+    async def _prefetch_hourly_async(self, grid_ids: List[int]) -> Dict[int, dict]:
+        connector = aiohttp.TCPConnector(limit=PREFETCH_CONCURRENCY)
+        timeout = aiohttp.ClientTimeout(total=10 * max(1, len(grid_ids) // PREFETCH_CONCURRENCY + 1))
+        sem = asyncio.Semaphore(PREFETCH_CONCURRENCY)
+        async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
+            results = await asyncio.gather(*[self._fetch_hourly_async(session, sem, g) for g in grid_ids])
+        return {gid: data for gid, data in results if data is not None}
+
+    def prefetch_hourly(self, grid_ids: List[int]) -> Dict[int, dict]:
+        """并发预取一批格网的24小时数据，返回 {grid_id: hourly_data}"""
+        if aiohttp is None or not grid_ids:
+            return {}
+        try:
+            return asyncio.run(self._prefetch_hourly_async(grid_ids))
+        except Exception as e:
+            print(f"[警告] 并发预取失败，改为逐个获取: {e}")
+            return {}
 
     def submit_label(self, grid_id: int, label: int) -> dict:
         """提交标签"""
@@ -101,26 +172,79 @@ class AutoLabeler:
         """前进到下一个格网"""
         return self.fetch_json("label_queue/advance", method="POST")
 
+    def submit_and_advance(self, grid_id: int, label: int) -> dict:
+        """提交标签并前进队列（服务器支持时合并为一次请求），返回队列前进结果"""
+        if self._label_advance_supported is False:
+            self.submit_label(grid_id, label)
+            return self.advance_queue()
+        resp = self.fetch_json("label", method="POST", data={
+            "grid_id": grid_id,
+            "label": label,
+            "advance": True
+        })
+        if "advance" in resp:
+            self._label_advance_supported = True
+            return resp["advance"]
+        # 旧版服务器忽略 advance 标志：标签已提交，单独前进队列，之后都走两次请求
+        self._label_advance_supported = False
+        return self.advance_queue()
+
     def copy_and_rename_screenshot(self, index: int, grid_id: int, label: int, label_name: str):
         """从服务器复制截图并重命名"""
         # 服务器上的截图文件名格式: {grid_id}-{label}.jpg
         source_filename = f"{grid_id}-{label}.jpg"
-        source_path = SHOTS_DIR / source_filename
+        source_path = SHOTS_PREFIX + source_filename
 
         # 新文件名格式: {序号:03d}_{grid_id}_{label}{label_name}.jpg
         target_filename = f"{index:03d}_{grid_id}_{label}{label_name}.jpg"
-        target_path = SCREENSHOTS_DIR / target_filename
+        target_path = SCREENSHOTS_PREFIX + target_filename
 
-        if source_path.exists():
+        if os.path.exists(source_path):
             try:
-                shutil.copy2(source_path, target_path)
+                # 两个目录同在 labels/ 下，优先建立硬链接（仅元数据操作）；跨文件系统或目标已存在时回退为复制
+                try:
+                    os.link(source_path, target_path)
+                except FileExistsError:
+                    # 目标已存在：若已是同一文件的硬链接则无需处理，否则覆盖
+                    if not os.path.samefile(source_path, target_path):
+                        shutil.copy2(source_path, target_path)
+                except OSError:
+                    shutil.copy2(source_path, target_path)
                 print(f"  ✓ 截图已保存: {target_filename}")
             except Exception as e:
                 print(f"  ⚠ 截图复制失败: {e}")
         else:
             print(f"  ⚠ 服务器截图不存在: {source_filename}")
 
-    def analyze_trend(self, hourly_data: dict) -> str:
+    @staticmethod
+    def _hourly_from_year(year_data: dict) -> Tuple[float, np.ndarray]:
+        """取某年第1周的24小时流量曲线，返回 (日总量, 24小时数组)；缺失或不足24小时补0
+
+        解析结果缓存在 year_data 的 "__hourly" 键上，同一份API数据被多次分析时不再重复转换列表
+        """
+        if not year_data:
+            return 0.0, np.zeros(24)
+        cached = year_data.get("__hourly")
+        if cached is not None:
+            return cached
+        weeks = year_data.get("total") or []
+        if not weeks:
+            arr = np.zeros(24)
+        else:
+            arr = np.asarray(weeks[0][:24], dtype=np.float64)
+            if arr.size < 24:
+                arr = np.pad(arr, (0, 24 - arr.size))
+        result = (float(arr.sum()), arr)
+        year_data["__hourly"] = result
+        return result
+
+    @staticmethod
+    def _flow_threshold(total_2021: float) -> int:
+        """根据2021年流量基数确定绝对变化阈值"""
+        # 区间为左开右闭（total > bin 才进入下一档），故用 bisect_left
+        return FLOW_THRESHOLD_VALS[bisect.bisect_left(FLOW_THRESHOLD_BINS, total_2021)]
+
+    def _compute_trend(self, hourly_2021: np.ndarray, hourly_2024: np.ndarray) -> Tuple[str, float, float, int, float]:
         """
         分析流量趋势：稳定/增长/衰减
 
@@ -130,118 +254,67 @@ class AutoLabeler:
         - 百分比变化仅在极端情况下作为辅助判断（>100%且绝对值也够大）
         - 特殊情况：如果绝对变化量不明显且曲线形状相似，判为稳定
 
-        Returns: "stable", "growth", "decay"
+        Returns: (trend, total_2021, total_2024, threshold, abs_change)
+        trend 为 "stable", "growth", "decay"
         """
-        if not hourly_data or "2021" not in hourly_data or "2024" not in hourly_data:
-            return "stable"  # 默认
-
         # 计算日均总量
-        def get_daily_total(year_data):
-            if not year_data or "total" not in year_data:
-                return 0
-            weeks = year_data["total"][:1]  # 取前1周
-            if not weeks:
-                return 0
-            # 计算24小时的平均值
-            hourly_avg = []
-            for h in range(24):
-                total = sum((week[h] if h < len(week) else 0) for week in weeks)
-                hourly_avg.append(total / 1)
-            return sum(hourly_avg), hourly_avg
-
-        total_2021, hourly_2021 = get_daily_total(hourly_data["2021"])
-        total_2024, hourly_2024 = get_daily_total(hourly_data["2024"])
-
-        if total_2021 == 0:
-            return "growth" if total_2024 > 200 else "stable"
-
+        total_2021 = float(hourly_2021.sum())
+        total_2024 = float(hourly_2024.sum())
         abs_change = total_2024 - total_2021
-        ratio_change = abs_change / total_2021
 
         # 基于视觉感受的判断逻辑
         # 核心思想：在图表上，y轴的刻度是固定的绝对值
         # 所以视觉感受主要取决于绝对变化量，而非百分比
+        threshold = self._flow_threshold(total_2021)
+        info = (total_2021, total_2024, threshold, abs_change)
 
-        # 根据流量基数设置不同的阈值
-        if total_2021 > 2000:
-            # 超大流量格网：绝对变化需要超过1000才算明显
-            threshold = 1000
-        elif total_2021 > 1000:
-            # 大流量格网：绝对变化需要超过900才算明显
-            threshold = 900
-        elif total_2021 > 500:
-            # 中大流量格网：绝对变化需要超过700
-            threshold = 700
-        elif total_2021 > 200:
-            # 中等流量格网：绝对变化需要超过400
-            threshold = 400
-        elif total_2021 > 100:
-            # 中小流量格网：绝对变化需要超过250
-            threshold = 250
-        else:
-            # 小流量格网：绝对变化需要超过200
-            threshold = 200
+        if total_2021 == 0:
+            return ("growth" if total_2024 > 200 else "stable",) + info
 
-        # 主要基于绝对变化判断
+        # 只基于绝对变化判断：超过阈值即为增长/衰减
         if abs_change > threshold:
-            return "growth"
-        elif abs_change < -threshold:
-            return "decay"
-        else:
-            # 绝对变化不明显时，检查曲线形状相似性
-            # 如果形状相似，视觉上看起来更稳定
-            if len(hourly_2021) == 24 and len(hourly_2024) == 24 and total_2021 > 0 and total_2024 > 0:
-                import statistics
-                try:
-                    # 归一化到0-1范围
-                    min_2021, max_2021 = min(hourly_2021), max(hourly_2021)
-                    min_2024, max_2024 = min(hourly_2024), max(hourly_2024)
-
-                    if max_2021 > min_2021 and max_2024 > min_2024:
-                        norm_2021 = [(h - min_2021) / (max_2021 - min_2021) for h in hourly_2021]
-                        norm_2024 = [(h - min_2024) / (max_2024 - min_2024) for h in hourly_2024]
-
-                        # 计算相关系数
-                        mean_2021 = statistics.mean(norm_2021)
-                        mean_2024 = statistics.mean(norm_2024)
-
-                        if mean_2021 > 0 and mean_2024 > 0:
-                            # 简化的皮尔逊相关系数计算
-                            numerator = sum((n1 - mean_2021) * (n2 - mean_2024) for n1, n2 in zip(norm_2021, norm_2024))
-                            var_2021 = sum((n1 - mean_2021) ** 2 for n1 in norm_2021)
-                            var_2024 = sum((n2 - mean_2024) ** 2 for n2 in norm_2024)
-
-                            if var_2021 > 0 and var_2024 > 0:
-                                correlation = numerator / (var_2021 ** 0.5 * var_2024 ** 0.5)
+            return ("growth",) + info
+        if abs_change < -threshold:
+            return ("decay",) + info
+
+        # 绝对变化不明显时，无论曲线形状是否相似，视觉上都判为稳定
+        return ("stable",) + info
+
+    def _trend_from_hourly(self, hourly_data: dict) -> Tuple[str, float, float, int, float]:
+        """从API返回的24小时数据计算趋势及中间量（缺少2021/2024年数据时趋势默认为稳定）"""
+        hourly_data = hourly_data or {}
+        _, hourly_2021 = self._hourly_from_year(hourly_data.get("2021", {}))
+        _, hourly_2024 = self._hourly_from_year(hourly_data.get("2024", {}))
+        trend_info = self._compute_trend(hourly_2021, hourly_2024)
+        if "2021" not in hourly_data or "2024" not in hourly_data:
+            return ("stable",) + trend_info[1:]
+        return trend_info
 
-                                # 如果曲线形状高度相似（相关系数>0.85），视觉上可能看起来稳定
-                                if correlation > 0.85:
-                                    return "stable"
-                except:
-                    pass  # 如果相关系数计算失败，继续返回stable
-
-            return "stable"
+    def analyze_trend(self, hourly_data: dict) -> str:
+        """分析流量趋势，Returns: "stable", "growth", "decay"（判断逻辑见 _compute_trend）"""
+        return self._trend_from_hourly(hourly_data)[0]
+
+    @staticmethod
+    def _build_ellipse_index(ellipses_data: dict) -> Dict[Tuple[int, int], float]:
+        """一次性建立 (year, grid_id) -> 椭圆面积 索引，避免每次查询线性扫描"""
+        index: Dict[Tuple[int, int], float] = {}
+        for year, items in (ellipses_data or {}).get("years", {}).items():
+            try:
+                y = int(year)
+            except (TypeError, ValueError):
+                continue
+            for item in items or []:
+                gid = item.get("grid_id")
+                if gid is None or (y, gid) in index:  # 与原线性扫描一致：保留第一条
+                    continue
+                axes = item.get("axes") or {}
+                # 椭圆面积 = π * a * b
+                index[(y, gid)] = math.pi * axes.get("a", 0) * axes.get("b", 0)
+        return index
 
     def get_ellipse_area(self, grid_id: int, year: int) -> Optional[float]:
         """获取格网某年的椭圆面积"""
-        if not self.ellipses_data:
-            return None
-
-        try:
-            years_data = self.ellipses_data.get("years", {})
-            year_data = years_data.get(str(year), [])
-
-            for item in year_data:
-                if item.get("grid_id") == grid_id:
-                    axes = item.get("axes", {})
-                    a = axes.get("a", 0)
-                    b = axes.get("b", 0)
-                    # 椭圆面积 = π * a * b
-                    return math.pi * a * b
-        except Exception as e:
-            pass
-
-        return None
+        return self._ellipse_area_index.get((year, grid_id))
 
     def analyze_spatial_pattern(self, grid_id: int) -> str:
         """
@@ -257,7 +330,11 @@ class AutoLabeler:
         # 尝试使用椭圆数据判断
         area_2021 = self.get_ellipse_area(grid_id, 2021)
         area_2024 = self.get_ellipse_area(grid_id, 2024)
+        return self._spatial_from_areas(area_2021, area_2024)
 
+    @staticmethod
+    def _spatial_from_areas(area_2021: Optional[float], area_2024: Optional[float]) -> str:
+        """根据2021/2024椭圆面积判断空间模式（逻辑见 analyze_spatial_pattern）"""
         if area_2021 and area_2024:
             if area_2021 == 0:
                 return "diffusion" if area_2024 > 0 else "static"
@@ -276,10 +353,12 @@ class AutoLabeler:
         # TODO: 可以基于flows_data的流线分布范围进行辅助判断
         return "static"
 
-    def predict_label(self, grid_id: int) -> Tuple[int, str, dict]:
+    def predict_label(self, grid_id: int, hourly_data: Optional[dict] = None) -> Tuple[int, str, dict]:
         """
         预测格网类型
 
+        hourly_data: 已预取的24小时数据；为None时通过API获取
+
         Returns: (label_number, label_name, metadata)
         metadata包含：
         - trend: 趋势判断
@@ -289,13 +368,17 @@ class AutoLabeler:
         """
         try:
             # 获取数据
-            hourly_data = self.get_grid_hourly(grid_id)
+            if hourly_data is None:
+                hourly_data = self.get_grid_hourly(grid_id)
 
-            # 分析趋势
-            trend = self.analyze_trend(hourly_data)  # stable/growth/decay
+            # 分析趋势（同时保留日总量、阈值等中间量供边缘案例检测复用）
+            trend_info = self._trend_from_hourly(hourly_data)
+            trend = trend_info[0]  # stable/growth/decay
 
             # 分析空间模式（基于椭圆数据）
-            spatial = self.analyze_spatial_pattern(grid_id)  # static/aggregation/diffusion
+            area_2021 = self.get_ellipse_area(grid_id, 2021)
+            area_2024 = self.get_ellipse_area(grid_id, 2024)
+            spatial = self._spatial_from_areas(area_2021, area_2024)  # static/aggregation/diffusion
 
             # 映射到标签
             trend_map = {"stable": 0, "growth": 3, "decay": 6}
@@ -304,7 +387,7 @@ class AutoLabeler:
             label = trend_map[trend] + spatial_map[spatial]
 
             # 判断是否是边缘案例
-            edge_info = self._check_edge_case(grid_id, hourly_data, trend, spatial)
+            edge_info = self._check_edge_case(trend_info, area_2021, area_2024, spatial)
 
             return label, LABEL_MAP.get(label, f"未知类型{label}"), edge_info
 
@@ -312,49 +395,17 @@ class AutoLabeler:
             print(f"  [分析错误] {e}")
             return 0, "其他", {"is_edge_case": False, "error": str(e)}
 
-    def _check_edge_case(self, grid_id: int, hourly_data: dict, trend: str, spatial: str) -> dict:
-        """检查是否是边缘案例"""
-        import math
-
-        # 获取流量和椭圆数据
-        def get_daily_total(year_data):
-            if not year_data or "total" not in year_data:
-                return 0
-            weeks = year_data["total"][:1]
-            if not weeks:
-                return 0
-            hourly_avg = []
-            for h in range(24):
-                total = sum((week[h] if h < len(week) else 0) for week in weeks)
-                hourly_avg.append(total / 1)
-            return sum(hourly_avg)
-
-        total_2021 = get_daily_total(hourly_data.get("2021", {}))
-        total_2024 = get_daily_total(hourly_data.get("2024", {}))
-        abs_change = total_2024 - total_2021
-
-        area_2021 = self.get_ellipse_area(grid_id, 2021)
-        area_2024 = self.get_ellipse_area(grid_id, 2024)
-
-        # 确定阈值
-        if total_2021 > 2000:
-            threshold = 1000
-        elif total_2021 > 1000:
-            threshold = 900
-        elif total_2021 > 500:
-            threshold = 700
-        elif total_2021 > 200:
-            threshold = 400
-        elif total_2021 > 100:
-            threshold = 250
-        else:
-            threshold = 200
+    def _check_edge_case(self, trend_info: Tuple[str, float, float, int, float],
+                         area_2021: Optional[float], area_2024: Optional[float], spatial: str) -> dict:
+        """检查是否是边缘案例（trend_info 为 _trend_from_hourly 的返回值）"""
+        trend, total_2021, total_2024, threshold, abs_change = trend_info
 
         # 判断是否接近阈值（±20%以内）
         is_edge_trend = abs(abs(abs_change) - threshold) / threshold < 0.2
 
         # 判断椭圆变化是否接近阈值（±3%以内）
         is_edge_spatial = False
+        area_change_ratio = None
         if area_2021 and area_2021 > 0:
             area_change_ratio = (area_2024 - area_2021) / area_2021
             # 如果在9%-15%之间（阈值12%±3%），认为是边缘
@@ -367,9 +418,11 @@ class AutoLabeler:
             "edge_reason": {
                 "trend_near_threshold": is_edge_trend,
                 "spatial_near_threshold": is_edge_spatial,
+                "flow_2021": total_2021,
+                "flow_2024": total_2024,
                 "flow_change": abs_change,
                 "flow_threshold": threshold,
-                "area_change_ratio": ((area_2024 - area_2021) / area_2021 * 100) if area_2021 and area_2021 > 0 else None,
+                "area_change_ratio": area_change_ratio * 100 if area_change_ratio is not None else None,
                 "area_threshold": 12.0
             },
             "confidence": {
@@ -406,101 +459,119 @@ class AutoLabeler:
             "errors": []
         }
 
-        # 边缘案例CSV文件
+        # 边缘案例CSV文件（循环中只收集行，批次结束时若有边缘案例再一次性写出）
         edge_csv_path = LABELS_DIR / "edge_cases.csv"
-        import csv
-        edge_csv_file = open(edge_csv_path, 'w', newline='', encoding='utf-8')
-        edge_csv_writer = csv.writer(edge_csv_file)
-        edge_csv_writer.writerow([
-            'grid_id', 'label', 'label_name',
-            'flow_2021', 'flow_2024', 'flow_change', 'flow_threshold',
-            'area_change_ratio', 'area_threshold',
-            'edge_trend', 'edge_spatial', 'reason'
-        ])
-
-        for i in range(count):
-            grid_id = remaining[i]
-            stats["total"] += 1
-            print(f"[{i+1}/{count}] 格网 ID: {grid_id}", end=" ")
-
-            try:
-                # 预测标签（带边缘案例检测）
-                label, label_name, edge_info = self.predict_label(grid_id)
+        edge_rows = []
+
+        # 并发预取本批次所有格网的24小时数据
+        hourly_cache = self.prefetch_hourly(remaining[:count])
+        if hourly_cache:
+            print(f"已预取 {len(hourly_cache)} 个格网的小时数据\n")
+
+        # 流水线：主线程分析/提交当前格网时，后台线程获取后续格网的小时数据
+        # （标签提交与队列前进仍在主线程按顺序执行）
+        executor = ThreadPoolExecutor(max_workers=PIPELINE_WORKERS)
+        pending = {}
+        advanced = 0  # 本批次已让服务器队列前进的次数（用于结尾打印进度，无需再请求队列）
+
+        def schedule(j: int):
+            if j >= count:
+                return
+            gid = remaining[j]
+            if gid not in hourly_cache and gid not in pending:
+                pending[gid] = executor.submit(self.get_grid_hourly, gid)
 
-                if label == 0:
-                    print(f"✗ 无法判断，跳过")
-                    self.advance_queue()
-                    continue
+        try:
+            for i in range(count):
+                grid_id = remaining[i]
+                stats["total"] += 1
+                print(f"[{i+1}/{count}] 格网 ID: {grid_id}", end=" ")
+                for j in range(i, i + PIPELINE_WORKERS + 1):
+                    schedule(j)
 
-                # 提交标签
-                self.submit_label(grid_id, label)
-                stats["success"] += 1
-
-                # 如果是边缘案例，记录下来
-                if edge_info.get("is_edge_case", False):
-                    stats["edge_cases"].append(grid_id)
-                    reason = edge_info.get("edge_reason", {})
-
-                    # 获取流量数据
-                    hourly_data = self.get_grid_hourly(grid_id)
-                    def get_daily_total(year_data):
-                        if not year_data or "total" not in year_data:
-                            return 0
-                        weeks = year_data["total"][:1]
-                        if not weeks:
-                            return 0
-                        hourly_avg = []
-                        for h in range(24):
-                            total = sum((week[h] if h < len(week) else 0) for week in weeks)
-                            hourly_avg.append(total / 1)
-                        return sum(hourly_avg)
-
-                    flow_2021 = get_daily_total(hourly_data.get("2021", {}))
-                    flow_2024 = get_daily_total(hourly_data.get("2024", {}))
-
-                    # 写入边缘案例CSV
-                    area_ratio = reason.get('area_change_ratio') or 0
+                try:
+                    # 预测标签（带边缘案例检测）
+                    hourly_data = hourly_cache.pop(grid_id, None)
+                    future = pending.pop(grid_id, None)
+                    if hourly_data is None and future is not None:
+                        try:
+                            hourly_data = future.result()
+                        except Exception:
+                            hourly_data = None  # predict_label 中重新获取并报告错误
+                    label, label_name, edge_info = self.predict_label(grid_id, hourly_data=hourly_data)
+
+                    if label == 0:
+                        print(f"✗ 无法判断，跳过")
+                        self.advance_queue()
+                        advanced += 1
+                        continue
+
+                    # 提交标签并前进到下一个
+                    self.submit_and_advance(grid_id, label)
+                    advanced += 1
+                    stats["success"] += 1
+
+                    # 如果是边缘案例，记录下来
+                    if edge_info.get("is_edge_case", False):
+                        stats["edge_cases"].append(grid_id)
+                        reason = edge_info.get("edge_reason", {})
+
+                        flow_2021 = reason.get("flow_2021", 0)
+                        flow_2024 = reason.get("flow_2024", 0)
+
+                        # 记录边缘案例行（批次结束时统一写入CSV）
+                        area_ratio = reason.get('area_change_ratio') or 0
+                        edge_rows.append([
+                            grid_id,
+                            label,
+                            label_name,
+                            f"{flow_2021:.1f}",
+                            f"{flow_2024:.1f}",
+                            f"{reason.get('flow_change', 0):.1f}",
+                            f"{reason.get('flow_threshold', 0):.0f}",
+                            f"{area_ratio:.1f}%",
+                            f"{reason.get('area_threshold', 0):.1f}%",
+                            reason.get('trend_near_threshold', False),
+                            reason.get('spatial_near_threshold', False),
+                            f"Trend:{'Y' if reason.get('trend_near_threshold') else 'N'} Spatial:{'Y' if reason.get('spatial_near_threshold') else 'N'}"
+                        ])
+
+                        print(f"✓ {label} [边缘案例]")
+                    else:
+                        print(f"✓ {label}")
+
+                except Exception as e:
+                    print(f"✗ 失败: {e}")
+                    stats["errors"].append({"grid_id": grid_id, "error": str(e)})
+                    break
+        finally:
+            for future in pending.values():
+                future.cancel()
+            executor.shutdown(wait=False)
+            if edge_rows:
+                # 大缓冲区 + 一次写出，避免与网络请求交错的零碎写入
+                with open(edge_csv_path, 'w', newline='', encoding='utf-8', buffering=1 << 16) as edge_csv_file:
+                    edge_csv_writer = csv.writer(edge_csv_file)
                     edge_csv_writer.writerow([
-                        grid_id,
-                        label,
-                        label_name,
-                        f"{flow_2021:.1f}",
-                        f"{flow_2024:.1f}",
-                        f"{reason.get('flow_change', 0):.1f}",
-                        f"{reason.get('flow_threshold', 0):.0f}",
-                        f"{area_ratio:.1f}%",
-                        f"{reason.get('area_threshold', 0):.1f}%",
-                        reason.get('trend_near_threshold', False),
-                        reason.get('spatial_near_threshold', False),
-                        f"Trend:{'Y' if reason.get('trend_near_threshold') else 'N'} Spatial:{'Y' if reason.get('spatial_near_threshold') else 'N'}"
+                        'grid_id', 'label', 'label_name',
+                        'flow_2021', 'flow_2024', 'flow_change', 'flow_threshold',
+                        'area_change_ratio', 'area_threshold',
+                        'edge_trend', 'edge_spatial', 'reason'
                     ])
-
-                    print(f"✓ {label} [边缘案例]")
-                else:
-                    print(f"✓ {label}")
-
-                # 前进到下一个
-                self.advance_queue()
-
-            except Exception as e:
-                print(f"✗ 失败: {e}")
-                stats["errors"].append({"grid_id": grid_id, "error": str(e)})
-                break
-
-        edge_csv_file.close()
+                    edge_csv_writer.writerows(edge_rows)
 
         print("\n" + "=" * 60)
         print(f"批次完成！")
         print(f"成功标注: {stats['success']}/{stats['total']}")
-        print(f"边缘案例: {len(stats['edge_cases'])} 个 ({len(stats['edge_cases'])/stats['success']*100:.1f}%)")
+        edge_pct = len(stats['edge_cases']) / stats['success'] * 100 if stats['success'] > 0 else 0
+        print(f"边缘案例: {len(stats['edge_cases'])} 个 ({edge_pct:.1f}%)")
         print(f"错误: {len(stats['errors'])} 个")
 
         if stats['edge_cases']:
             print(f"\n⚠ 边缘案例已保存到: {edge_csv_path}")
             print(f"  请人工检查这 {len(stats['edge_cases'])} 个格网的标签")
 
-        queue_info = self.get_queue()
-        print(f"\n当前进度: {queue_info.get('index', 0)}/{len(queue_info.get('queue', []))}")
+        print(f"\n当前进度: {index + advanced}/{len(queue)}")
 
         return stats
 
@@ -13,12 +13,23 @@
 - 空间方向的聚集程度对比（椭圆面积变化）→ 判断聚集/扩散
 """
 
+import os
+import json
 import requests
+from requests.adapters import HTTPAdapter
 import time
 import math
 import shutil
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
 from pathlib import Path
-from typing import Optional, Tuple
+from typing import Dict, Optional, Tuple
+
+try:
+    import orjson  # type: ignore
+    _json_loads = orjson.loads
+except Exception:
+    _json_loads = json.loads  # optional: 没有orjson时使用标准库
 
 # 配置
 BASE_URL = "http://127.0.0.1:8000"
@@ -30,6 +41,14 @@ LABELS_DIR = SCRIPT_DIR / "labels"
 SHOTS_DIR = LABELS_DIR / "shots"  # 服务器保存截图的目录
 SCREENSHOTS_DIR = LABELS_DIR / "screenshots"  # 按序号保存截图的目录
 
+# 后台预取小时数据的线程数 / 提前预取的格网数量
+PREFETCH_WORKERS = 2
+PREFETCH_WINDOW = 32
+# 每次批量获取小时数据的格网数量（一次 /api/hourly_bulk 请求）
+HOURLY_BULK_SIZE = 128
+# 每批提交的标签数量
+LABEL_BATCH_SIZE = 32
+
 # 确保目录存在
 SCREENSHOTS_DIR.mkdir(parents=True, exist_ok=True)
 
@@ -42,14 +61,27 @@ LABEL_MAP = {
 }
 
 
+def _daily_total(year_data: Optional[dict]) -> float:
+    """取第1周前24小时的流量之和（日总量）"""
+    weeks = year_data.get("total") if year_data else None
+    if not weeks:
+        return 0.0
+    return float(np.asarray(weeks[0][:24], dtype=np.float64).sum())
+
+
 class AutoLabeler4:
     def __init__(self, base_url: str = BASE_URL, ellipses_path: Optional[str] = None):
         self.base_url = base_url
         self.api_base = f"{base_url}/api"
         self.session = requests.Session()
+        # 连接池需容纳所有预取线程，避免连接被反复建立/丢弃
+        adapter = HTTPAdapter(pool_connections=32, pool_maxsize=32)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
 
         # 加载椭圆数据（用于空间模式判断）
         self.ellipses_data = None
+        self._ellipse_area: Dict[int, Dict[int, float]] = {}  # year -> {grid_id: 椭圆面积}
         if ellipses_path is None:
             # 默认路径
             script_dir = Path(__file__).parent
@@ -57,9 +89,9 @@ class AutoLabeler4:
 
         if ellipses_path and Path(ellipses_path).exists():
             try:
-                import json
-                with open(ellipses_path, 'r') as f:
-                    self.ellipses_data = json.load(f)
+                with open(ellipses_path, 'rb') as f:
+                    self.ellipses_data = _json_loads(f.read())
+                self._ellipse_area = self._build_ellipse_index(self.ellipses_data)
                 print(f"[已加载椭圆数据: {ellipses_path}]")
             except Exception as e:
                 print(f"[警告] 加载椭圆数据失败: {e}")
@@ -76,7 +108,7 @@ class AutoLabeler4:
             raise ValueError(f"不支持的HTTP方法: {method}")
 
         if resp.status_code == 200:
-            return resp.json()
+            return _json_loads(resp.content)
         else:
             raise Exception(f"API请求失败: {resp.status_code} - {resp.text}")
 
@@ -96,7 +128,12 @@ class AutoLabeler4:
 
     def get_grid_hourly(self, grid_id: int) -> dict:
         """获取格网的24小时数据"""
-        return self.fetch_json(f"grid_hourly/{grid_id}")
+        return self.fetch_json(f"hourly?grid_id={grid_id}")
+
+    def get_grid_hourly_bulk(self, grid_ids: list) -> Dict[int, dict]:
+        """一次请求获取多个格网的24小时数据，返回 {grid_id: hourly_data}"""
+        data = self.fetch_json(f"hourly_bulk?ids={','.join(str(g) for g in grid_ids)}")
+        return {int(g): v for g, v in data.items()}
 
     def get_grid_flows(self, grid_id: int) -> dict:
         """获取格网的流线数据"""
@@ -113,6 +150,13 @@ class AutoLabeler4:
         """前进到下一个格网"""
         return self.fetch_json("label_queue/advance", method="POST")
 
+    def submit_label_batch(self, labels: list, advance_to: Optional[int] = None) -> dict:
+        """批量提交标签 [{"grid_id":..., "label":...}]，并将队列指针移动到 advance_to"""
+        data = {"labels": labels}
+        if advance_to is not None:
+            data["advance_to"] = advance_to
+        return self.fetch_json("label_batch", method="POST", data=data)
+
     def copy_and_rename_screenshot(self, index: int, grid_id: int, label: int, label_name: str):
         """从服务器复制截图并重命名"""
         # 服务器上的截图文件名格式: {grid_id}-{label}.jpg
@@ -125,14 +169,22 @@ class AutoLabeler4:
 
         if source_path.exists():
             try:
-                shutil.copy2(source_path, target_path)
+                # 两个目录同在 labels/ 下，优先建立硬链接（仅元数据操作）；跨文件系统或目标已存在时回退为复制
+                try:
+                    os.link(source_path, target_path)
+                except FileExistsError:
+                    # 目标已存在：若已是同一文件的硬链接则无需处理，否则覆盖
+                    if not os.path.samefile(source_path, target_path):
+                        shutil.copy2(source_path, target_path)
+                except OSError:
+                    shutil.copy2(source_path, target_path)
                 print(f"  ✓ 截图已保存: {target_filename}")
             except Exception as e:
                 print(f"  ⚠ 截图复制失败: {e}")
         else:
             print(f"  ⚠ 服务器截图不存在: {source_filename}")
 
-    def analyze_trend(self, hourly_data: dict) -> str:
+    def analyze_trend(self, hourly_data: dict) -> Tuple[str, float, float]:
         """
         分析流量趋势：增长/衰减（强制二分类）
 
@@ -143,74 +195,48 @@ class AutoLabeler4:
         - 超过阈值且为负 → 衰减
         - 未超过阈值时，基于变化方向进行判断（总是倾向于做出判断）
 
-        Returns: "growth" 或 "decay"
+        Returns: (趋势, 2021日总量, 2024日总量)，趋势为 "growth" 或 "decay"
         """
-        if not hourly_data or "2021" not in hourly_data or "2024" not in hourly_data:
-            return "growth"  # 默认返回增长
-
-        # 计算日均总量
-        def get_daily_total(year_data):
-            if not year_data or "total" not in year_data:
-                return 0
-            weeks = year_data["total"][:1]  # 取前1周
-            if not weeks:
-                return 0
-            # 计算24小时的平均值
-            hourly_avg = []
-            for h in range(24):
-                total = sum((week[h] if h < len(week) else 0) for week in weeks)
-                hourly_avg.append(total / 1)
-            return sum(hourly_avg)
-
-        total_2021 = get_daily_total(hourly_data["2021"])
-        total_2024 = get_daily_total(hourly_data["2024"])
+        hourly_data = hourly_data or {}
+        # 计算日均总量（同时作为元数据返回，避免重复计算）
+        total_2021 = _daily_total(hourly_data.get("2021"))
+        total_2024 = _daily_total(hourly_data.get("2024"))
 
-        if total_2021 == 0:
-            return "growth"  # 从无到有，判为增长
-
-        abs_change = total_2024 - total_2021
-
-        # 根据流量基数设置阈值
-        if total_2021 > 2000:
-            threshold = 1000
-        elif total_2021 > 1000:
-            threshold = 900
-        elif total_2021 > 500:
-            threshold = 700
-        elif total_2021 > 200:
-            threshold = 400
-        elif total_2021 > 100:
-            threshold = 250
-        else:
-            threshold = 200
+        if "2021" not in hourly_data or "2024" not in hourly_data:
+            return "growth", total_2021, total_2024  # 默认返回增长
 
-        # 强制二分类：基于变化方向
-        if abs_change >= 0:
-            return "growth"
-        else:
-            return "decay"
+        if total_2021 == 0:
+            return "growth", total_2021, total_2024  # 从无到有，判为增长
+
+        # 强制二分类只看变化方向，流量基数阈值不影响结果，因此不再计算阈值
+        if total_2024 - total_2021 >= 0:
+            return "growth", total_2021, total_2024
+        return "decay", total_2021, total_2024
+
+    @staticmethod
+    def _build_ellipse_index(ellipses_data: dict) -> Dict[int, Dict[int, float]]:
+        """一次性建立 year -> {grid_id: 椭圆面积} 索引，避免每次查询线性扫描"""
+        index: Dict[int, Dict[int, float]] = {}
+        for year, items in (ellipses_data or {}).get("years", {}).items():
+            try:
+                by_grid = index.setdefault(int(year), {})
+            except (TypeError, ValueError):
+                continue
+            for item in items or []:
+                gid = item.get("grid_id")
+                if gid is None or gid in by_grid:  # 与原线性扫描一致：保留第一条
+                    continue
+                # 兼容两种格式：{"ellipse": {"axes": ...}} 与 {"axes": ...}
+                axes = (item.get("ellipse") or {}).get("axes") or item.get("axes") or {}
+                a = axes.get("a", 0)  # 长半轴
+                b = axes.get("b", 0)  # 短半轴
+                # 椭圆面积 = π * a * b
+                by_grid[gid] = math.pi * a * b
+        return index
 
     def get_ellipse_area(self, grid_id: int, year: int) -> Optional[float]:
         """获取格网某年的椭圆面积"""
-        if not self.ellipses_data:
-            return None
-
-        try:
-            years_data = self.ellipses_data.get("years", {})
-            year_data = years_data.get(str(year), [])
-
-            for item in year_data:
-                if item.get("grid_id") == grid_id:
-                    ellipse = item.get("ellipse", {})
-                    axes = ellipse.get("axes", {})
-                    a = axes.get("a", 0)  # 长半轴
-                    b = axes.get("b", 0)  # 短半轴
-                    # 椭圆面积 = π * a * b
-                    return math.pi * a * b
-        except Exception as e:
-            pass
-
-        return None
+        return self._ellipse_area.get(year, {}).get(grid_id)
 
     def analyze_spatial_pattern(self, grid_id: int) -> str:
         """
@@ -243,10 +269,12 @@ class AutoLabeler4:
         # 流量增长倾向于扩散，流量衰减倾向于聚集（这是一种简化假设）
         return "diffusion"  # 默认返回扩散
 
-    def predict_label(self, grid_id: int) -> Tuple[int, str, dict]:
+    def predict_label(self, grid_id: int, hourly_data: Optional[dict] = None) -> Tuple[int, str, dict]:
         """
         预测格网类型（4分类）
 
+        hourly_data: 已预取的24小时数据；为None时通过API获取
+
         Returns: (label_number, label_name, metadata)
         metadata包含：
         - trend: 趋势判断 (growth/decay)
@@ -256,10 +284,11 @@ class AutoLabeler4:
         """
         try:
             # 获取数据
-            hourly_data = self.get_grid_hourly(grid_id)
+            if hourly_data is None:
+                hourly_data = self.get_grid_hourly(grid_id)
 
             # 分析趋势
-            trend = self.analyze_trend(hourly_data)  # growth/decay
+            trend, total_2021, total_2024 = self.analyze_trend(hourly_data)  # growth/decay
 
             # 分析空间模式
             spatial = self.analyze_spatial_pattern(grid_id)  # aggregation/diffusion
@@ -278,7 +307,7 @@ class AutoLabeler4:
                     label = 4  # 衰减扩散型
 
             # 获取元数据
-            metadata = self._get_metadata(grid_id, hourly_data, trend, spatial)
+            metadata = self._get_metadata(grid_id, total_2021, total_2024, trend, spatial)
 
             return label, LABEL_MAP.get(label, f"未知类型{label}"), metadata
 
@@ -286,23 +315,9 @@ class AutoLabeler4:
             print(f"  [分析错误] {e}")
             return 0, "其他", {"error": str(e)}
 
-    def _get_metadata(self, grid_id: int, hourly_data: dict, trend: str, spatial: str) -> dict:
-        """获取元数据信息"""
-        # 获取流量数据
-        def get_daily_total(year_data):
-            if not year_data or "total" not in year_data:
-                return 0
-            weeks = year_data["total"][:1]
-            if not weeks:
-                return 0
-            hourly_avg = []
-            for h in range(24):
-                total = sum((week[h] if h < len(week) else 0) for week in weeks)
-                hourly_avg.append(total / 1)
-            return sum(hourly_avg)
-
-        total_2021 = get_daily_total(hourly_data.get("2021", {}))
-        total_2024 = get_daily_total(hourly_data.get("2024", {}))
+    def _get_metadata(self, grid_id: int, total_2021: float, total_2024: float,
+                      trend: str, spatial: str) -> dict:
+        """获取元数据信息（流量总量由 analyze_trend 计算后传入）"""
         flow_change = total_2024 - total_2021
         flow_change_ratio = (flow_change / total_2021 * 100) if total_2021 > 0 else 0
 
@@ -358,44 +373,98 @@ class AutoLabeler4:
             "errors": []
         }
 
-        for i in range(count):
-            grid_id = remaining[i]
-            stats["total"] += 1
-            print(f"[{i+1}/{count}] 格网 ID: {grid_id}", end=" ")
-
-            try:
-                # 预测标签
-                label, label_name, metadata = self.predict_label(grid_id)
-
-                if label == 0:
-                    print(f"✗ 无法判断，跳过")
-                    self.advance_queue()
-                    continue
-
-                # 提交标签
-                self.submit_label(grid_id, label)
-                stats["success"] += 1
-                stats["label_counts"][label] += 1
-
-                # 显示详细信息
-                flow_change = metadata.get("flow_change", 0)
-                flow_ratio = metadata.get("flow_change_ratio", 0)
-                area_ratio = metadata.get("area_change_ratio", 0)
+        # 流水线：小时数据按 HOURLY_BULK_SIZE 个格网一组由后台线程批量预取，主线程只做分析与按顺序提交
+        executor = ThreadPoolExecutor(max_workers=PREFETCH_WORKERS)
+        futures = {}  # 组号 -> future({grid_id: hourly_data})
+
+        def prefetch(j: int):
+            c = j // HOURLY_BULK_SIZE
+            if j < count and c not in futures:
+                ids = remaining[c * HOURLY_BULK_SIZE:min((c + 1) * HOURLY_BULK_SIZE, count)]
+                futures[c] = executor.submit(self.get_grid_hourly_bulk, ids)
+
+        # 标签先在本地累积，每 LABEL_BATCH_SIZE 个合并为一次请求提交，同时把队列指针移到已处理位置
+        pending = []
+        done = 0  # 已处理（标注或跳过）的格网数
+        flushed = 0  # 已同步到服务器的处理数
+
+        def flush():
+            nonlocal flushed
+            if not pending and flushed == done:
+                return
+            self.submit_label_batch(pending, advance_to=index + done)
+            pending.clear()
+            flushed = done
+
+        # 循环内频繁使用的方法/字典先绑定为局部变量，省去每次的属性与下标查找
+        predict_label = self.predict_label
+        label_counts = stats["label_counts"]
+        add_pending = pending.append
+        get_future = futures.get
 
-                print(f"✓ {label} ({label_name})")
-                print(f"    流量: {metadata.get('flow_2021', 0):.0f} → {metadata.get('flow_2024', 0):.0f} "
-                      f"({flow_change:+.0f}, {flow_ratio:+.1f}%)")
-
-                if area_ratio is not None:
-                    print(f"    椭圆面积变化: {area_ratio:+.1f}%")
-
-                # 前进到下一个
-                self.advance_queue()
-
-            except Exception as e:
-                print(f"✗ 失败: {e}")
-                stats["errors"].append({"grid_id": grid_id, "error": str(e)})
-                break
+        try:
+            for i in range(count):
+                grid_id = remaining[i]
+                stats["total"] += 1
+                print(f"[{i+1}/{count}] 格网 ID: {grid_id}", end=" ")
+                prefetch(i)
+                prefetch(i + PREFETCH_WINDOW)  # 接近组末尾时提前请求下一组
+
+                try:
+                    # 预测标签（预取失败时由 predict_label 重新获取并报告错误）
+                    c = i // HOURLY_BULK_SIZE
+                    try:
+                        hourly_data = get_future(c).result().get(grid_id)
+                    except Exception:
+                        hourly_data = None
+                    if (i + 1) % HOURLY_BULK_SIZE == 0:
+                        futures.pop(c, None)  # 本组已处理完，释放其数据
+                    label, label_name, metadata = predict_label(grid_id, hourly_data=hourly_data)
+
+                    if label == 0:
+                        print(f"✗ 无法判断，跳过")
+                        done += 1
+                        continue
+
+                    # 加入待提交标签
+                    add_pending({"grid_id": grid_id, "label": label})
+                    stats["success"] += 1
+                    label_counts[label] += 1
+
+                    # 显示详细信息
+                    flow_change = metadata.get("flow_change", 0)
+                    flow_ratio = metadata.get("flow_change_ratio", 0)
+                    area_ratio = metadata.get("area_change_ratio", 0)
+
+                    print(f"✓ {label} ({label_name})")
+                    print(f"    流量: {metadata.get('flow_2021', 0):.0f} → {metadata.get('flow_2024', 0):.0f} "
+                          f"({flow_change:+.0f}, {flow_ratio:+.1f}%)")
+
+                    if area_ratio is not None:
+                        print(f"    椭圆面积变化: {area_ratio:+.1f}%")
+
+                    done += 1
+                    if len(pending) >= LABEL_BATCH_SIZE:
+                        flush()
+
+                except Exception as e:
+                    print(f"✗ 失败: {e}")
+                    stats["errors"].append({"grid_id": grid_id, "error": str(e)})
+                    break
+        finally:
+            for future in futures.values():
+                future.cancel()
+            executor.shutdown(wait=False)
+
+        # 提交剩余标签
+        try:
+            flush()
+        except Exception as e:
+            print(f"✗ 标签提交失败: {e}")
+            stats["success"] -= len(pending)
+            for item in pending:
+                stats["label_counts"][item["label"]] -= 1
+            stats["errors"].append({"grid_id": pending[0]["grid_id"] if pending else None, "error": str(e)})
 
         print("\n" + "=" * 60)
         print(f"批次完成！")
@@ -411,8 +480,8 @@ class AutoLabeler4:
             for err in stats["errors"][:5]:  # 只显示前5个错误
                 print(f"  - 格网 {err['grid_id']}: {err['error']}")
 
-        queue_info = self.get_queue()
-        print(f"\n当前进度: {queue_info.get('index', 0)}/{len(queue_info.get('queue', []))}")
+        # 队列指针已随每次批量提交同步到 index + flushed，直接用本地状态打印
+        print(f"\n当前进度: {index + flushed}/{len(queue)}")
 
         return stats
 
@@ -20,23 +20,91 @@ LABELS_DIR = SCRIPT_DIR / "labels"
 LABELS_CSV = LABELS_DIR / "labels.csv"
 
 
-def get_label_counts():
-    """获取当前各类别的标注数量"""
-    if not LABELS_CSV.exists():
-        return Counter()
-
-    counts = Counter()
-    with LABELS_CSV.open('r', newline='') as f:
-        reader = csv.DictReader(f)
-        for row in reader:
-            try:
-                label = int(row['label'])
+class LabelCounter:
+    """
+    增量统计 labels.csv 中各类别数量
+
+    labels.csv 通常只会被追加写入，因此记录上次读到的字节偏移，每次只解析新增的行，
+    避免每轮都重新读取整个文件。以下情况视为文件被重写（撤销/导入/清空）并从头重新统计：
+    inode变化、文件变短、表头变化、偏移处结尾的最后一行与上次读到的不一致。
+    仅改写中间行且最后一行及其位置不变的原地修改无法察觉。
+    """
+
+    def __init__(self, path: Path):
+        self.path = path
+        self._ino = None
+        self._offset = 0
+        self._header = b""
+        self._tail = b""  # 上次读到的最后一个完整行（以 _offset 结尾）
+        self._label_idx = None
+        self._counts = Counter()
+
+    def _reset(self):
+        self._offset = 0
+        self._header = b""
+        self._tail = b""
+        self._label_idx = None
+        self._counts = Counter()
+
+    def update(self) -> Counter:
+        """读取上次偏移之后新增的行，返回当前各类别计数"""
+        try:
+            st = self.path.stat()
+        except FileNotFoundError:
+            self._reset()
+            return Counter()
+        if st.st_ino != self._ino or st.st_size < self._offset:
+            self._reset()  # 文件被替换、截断或重写
+            self._ino = st.st_ino
+
+        with self.path.open('rb') as f:
+            header = f.readline()
+            if header != self._header:
+                # 表头变化（首次读取或文件被重写）：从头统计
+                self._reset()
+                if not header.endswith(b"\n"):
+                    return Counter()
+                self._header = header
+                self._offset = len(header)
+                cols = [c.strip() for c in next(csv.reader([header.decode("utf-8", "replace")]), [])]
+                self._label_idx = cols.index("label") if "label" in cols else None
+            if self._label_idx is None:
+                return Counter(self._counts)
+
+            if self._offset > len(header):
+                # 偏移之前应当仍是上次读到的最后一行，否则说明文件已被改写（如撤销后又追加了等长的行）
+                f.seek(self._offset - len(self._tail))
+                if f.read(len(self._tail)) != self._tail:
+                    self._counts = Counter()
+                    self._offset = len(header)
+                    self._tail = b""
+            f.seek(self._offset)
+            chunk = f.read()
+            end = chunk.rfind(b"\n") + 1  # 只处理完整的行，末尾未写完的行留到下次
+            idx = self._label_idx
+            counts = self._counts
+            # csv.reader + 列下标：不为每行构造dict，同时正确处理带引号/逗号的备注列
+            lines = chunk[:end].decode("utf-8", "replace").splitlines(True)
+            for row in csv.reader(lines):
+                try:
+                    label = int(row[idx])
+                except (ValueError, IndexError):
+                    continue
                 if 1 <= label <= 9:
                     counts[label] += 1
-            except (ValueError, KeyError):
-                continue
+            if end:
+                self._tail = chunk[chunk.rfind(b"\n", 0, end - 1) + 1:end]
+            self._offset += end
+
+        return Counter(counts)
+
 
-    return counts
+_label_counter = LabelCounter(LABELS_CSV)
+
+
+def get_label_counts():
+    """获取当前各类别的标注数量"""
+    return _label_counter.update()
 
 
 def print_progress(counts, min_count):
@@ -46,23 +114,20 @@ def print_progress(counts, min_count):
     print("-" * 70)
 
     total = sum(counts.values())
-    completed = 0
+    # 每个类别只取一次计数与名称
+    items = [(label, counts.get(label, 0), LABEL_MAP.get(label, f"类型{label}")) for label in range(1, 10)]
+    completed = sum(1 for _, count, _ in items if count >= min_count)
 
-    for label in range(1, 10):
-        count = counts.get(label, 0)
-        name = LABEL_MAP.get(label, f"类型{label}")
+    bar_length = 30
+    for label, count, name in items:
         progress = min(100, (count / min_count) * 100)
         status = "✓" if count >= min_count else " "
 
-        bar_length = 30
         filled = int(bar_length * progress / 100)
         bar = "█" * filled + "░" * (bar_length - filled)
 
         print(f"[{status}] {label}. {name:12s} [{bar}] {count:4d}/{min_count} ({progress:5.1f}%)")
 
-        if count >= min_count:
-            completed += 1
-
     print("-" * 70)
     print(f"总计: {total} 个样本")
     print(f"完成类别: {completed}/9")
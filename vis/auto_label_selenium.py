@@ -6,21 +6,27 @@
 1. 自动控制浏览器进行标注
 2. 自动截图保存（序号+格网ID+类型）
 3. 只显示2021和2024年的数据
+4. 可选多浏览器并行：python auto_label_selenium.py <数量> <浏览器数>
 """
 
-import time
 import json
 import math
 from pathlib import Path
-from typing import Optional, Tuple
-from selenium import webdriver
-from selenium.webdriver.common.by import By
-from selenium.webdriver.support.ui import WebDriverWait
-from selenium.webdriver.support import expected_conditions as EC
-from selenium.webdriver.chrome.options import Options
+from typing import List, Optional, Tuple
+# selenium / requests 在用到时才导入（与 Keys 的用法一致），脚本启动不必加载整个 webdriver 包
+
+try:
+    import orjson  # type: ignore
+    _json_loads = orjson.loads
+except Exception:
+    _json_loads = json.loads  # optional: 没有orjson时使用标准库
 
 # 配置
 BASE_URL = "http://127.0.0.1:8055"
+# 提交后等待页面切换到下一个格网的最长时间（秒）
+ADVANCE_TIMEOUT = 2.0
+# 并行模式下，等待页面展示指定格网的最长时间（秒）
+SHOW_GRID_TIMEOUT = 10.0
 SCREENSHOTS_DIR = Path(__file__).parent / "labels" / "screenshots"
 
 # 标签映射
@@ -33,6 +39,10 @@ LABEL_MAP = {
 
 class SeleniumAutoLabeler:
     def __init__(self, headless: bool = False):
+        from selenium import webdriver
+        from selenium.webdriver.support.ui import WebDriverWait
+        from selenium.webdriver.chrome.options import Options
+
         # 设置Chrome选项
         chrome_options = Options()
         if headless:
@@ -56,19 +66,21 @@ class SeleniumAutoLabeler:
         ellipses_path = Path(__file__).parent / "appdata" / "ellipses.json"
         if ellipses_path.exists():
             try:
-                with open(ellipses_path, 'r') as f:
-                    return json.load(f)
+                with open(ellipses_path, 'rb') as f:
+                    return _json_loads(f.read())
             except Exception as e:
                 print(f"[警告] 加载椭圆数据失败: {e}")
         return None
 
     def open_page(self):
         """打开标注页面"""
+        from selenium.webdriver.common.by import By
+        from selenium.webdriver.support import expected_conditions as EC
         print(f"正在打开页面: {BASE_URL}")
         self.driver.get(BASE_URL)
 
-        # 等待页面加载
-        time.sleep(2)
+        # 等待页面加载（年份复选框出现即可操作）
+        self.wait.until(EC.presence_of_element_located((By.ID, "yearChk2021")))
 
         # 取消勾选2018年，只显示2021和2024
         print("设置年份：只显示2021和2024年")
@@ -76,7 +88,7 @@ class SeleniumAutoLabeler:
             chk_2018 = self.driver.find_element(By.ID, "yearChk2018")
             if chk_2018.is_selected():
                 chk_2018.click()
-                time.sleep(0.5)
+                self.wait.until(EC.element_selection_state_to_be(chk_2018, False))
 
             # 确保2021和2024已勾选
             chk_2021 = self.driver.find_element(By.ID, "yearChk2021")
@@ -85,13 +97,41 @@ class SeleniumAutoLabeler:
                 chk_2021.click()
             if not chk_2024.is_selected():
                 chk_2024.click()
-            time.sleep(1)
+            self.wait.until(EC.element_selection_state_to_be(chk_2021, True))
+            self.wait.until(EC.element_selection_state_to_be(chk_2024, True))
+            # 等待当前格网信息渲染完成
+            self.wait.until(lambda d: self._read_grid_id(d) is not None)
             print("✓ 年份设置完成")
         except Exception as e:
             print(f"✗ 设置年份失败: {e}")
 
+    @staticmethod
+    def _read_grid_id(driver) -> Optional[int]:
+        """读取页面上的当前格网ID（用于轮询，失败时静默返回None）"""
+        from selenium.webdriver.common.by import By
+        try:
+            info = driver.find_element(By.ID, "currentInfo").text
+            if "ID" in info:
+                return int(info.split()[1])
+        except Exception:
+            pass
+        return None
+
+    def wait_grid_change(self, old_id: int, timeout: float = ADVANCE_TIMEOUT) -> bool:
+        """等待页面切换到下一个格网（轮询格网ID变化，代替固定sleep）"""
+        from selenium.webdriver.support.ui import WebDriverWait
+        from selenium.common.exceptions import TimeoutException
+        try:
+            WebDriverWait(self.driver, timeout, poll_frequency=0.02).until(
+                lambda d: self._read_grid_id(d) != old_id
+            )
+            return True
+        except TimeoutException:
+            return False
+
     def get_current_grid_id(self) -> Optional[int]:
         """获取当前格网ID"""
+        from selenium.webdriver.common.by import By
         try:
             info = self.driver.find_element(By.ID, "currentInfo").text
             # 格式: "ID 270910 (113.2891,22.1697) 珠海市 斗门区"
@@ -214,33 +254,19 @@ class SeleniumAutoLabeler:
         document.dispatchEvent(event);
         """
         self.driver.execute_script(script)
-        time.sleep(0.3)  # 等待提交和截图
 
     def take_screenshot(self, index: int, grid_id: int, label: int, label_name: str):
         """保存截图"""
-        filename = f"{index:03d}_{grid_id}_{label}{label_name}.jpg"
+        from selenium.webdriver.common.by import By
+        # 浏览器原生截图（CDP Page.captureScreenshot）只能输出PNG，因此本地副本使用 .png 扩展名
+        filename = f"{index:03d}_{grid_id}_{label}{label_name}.png"
         filepath = SCREENSHOTS_DIR / filename
 
-        # 使用html2canvas截取整个页面
-        script = """
-        return html2canvas(document.querySelector('.app'), {
-            backgroundColor: '#ffffff',
-            scale: 1
-        }).then(canvas => {
-            return canvas.toDataURL('image/jpeg', 0.92);
-        });
-        """
         try:
-            data_url = self.driver.execute_script(script)
-            if data_url:
-                # 解析base64数据
-                header, encoded = data_url.split(",", 1)
-                import base64
-                data = base64.b64decode(encoded)
-
-                with open(filepath, 'wb') as f:
-                    f.write(data)
-                print(f"  ✓ 截图已保存: {filename}")
+            # 只截取 .app 区域（与页面上传的截图范围一致），直接拿到PNG字节，无需base64往返
+            data = self.driver.find_element(By.CLASS_NAME, "app").screenshot_as_png
+            filepath.write_bytes(data)
+            print(f"  ✓ 截图已保存: {filename}")
         except Exception as e:
             print(f"  ✗ 截图失败: {e}")
 
@@ -264,6 +290,7 @@ class SeleniumAutoLabeler:
                 if label == 0:
                     print(f"  → 无法判断，跳过")
                     self.press_key("Enter")  # 按Enter跳过
+                    self.wait_grid_change(grid_id)
                     continue
 
                 print(f"  → 判断: {label} ({label_name})")
@@ -276,8 +303,9 @@ class SeleniumAutoLabeler:
 
                 print(f"  ✓ 已提交")
 
-                # 等待页面跳转
-                time.sleep(0.5)
+                # 等待页面跳转（格网ID变化即完成）
+                if not self.wait_grid_change(grid_id):
+                    print(f"  ⚠ 等待跳转超时")
 
             except Exception as e:
                 print(f"  ✗ 失败: {e}")
@@ -299,19 +327,147 @@ class SeleniumAutoLabeler:
         document.dispatchEvent(event);
         """
         self.driver.execute_script(script)
-        time.sleep(0.3)
+
+    def show_grid(self, grid_id: int, timeout: float = SHOW_GRID_TIMEOUT) -> bool:
+        """通过页面上的“格网ID”输入框直接定位到指定格网，等待其展示完成"""
+        from selenium.webdriver.common.by import By
+        from selenium.webdriver.support.ui import WebDriverWait
+        from selenium.webdriver.support import expected_conditions as EC
+        from selenium.common.exceptions import TimeoutException
+        self.driver.execute_script(
+            "const el = document.getElementById('gridIdInput'); el.value = arguments[0];"
+            "document.getElementById('gridIdConfirmBtn').click();",
+            str(grid_id),
+        )
+        try:
+            WebDriverWait(self.driver, timeout, poll_frequency=0.02).until(
+                EC.text_to_be_present_in_element((By.ID, "gridLookupStatus"), f"已展示格网 {grid_id}")
+            )
+            return True
+        except TimeoutException:
+            return False
+
+    def post_label(self, grid_id: int, label: int) -> bool:
+        """直接调用 /api/label 保存标签（不移动服务器队列指针）"""
+        script = """
+        const done = arguments[arguments.length - 1];
+        fetch('/api/label', {
+            method: 'POST',
+            headers: {'Content-Type': 'application/json'},
+            body: JSON.stringify({grid_id: arguments[0], label: arguments[1]})
+        }).then(r => done(r.ok)).catch(e => done(false));
+        """
+        return bool(self.driver.execute_async_script(script, grid_id, label))
+
+    def run_range(self, grid_ids: List[int], start: int = 0) -> int:
+        """
+        标注预先分配的一段格网（并行模式下每个浏览器各处理一段）
+
+        start: 该段在本批次中的起始序号，用于截图编号
+        Returns: 按顺序连续处理完的格网数（遇到错误即停止）
+        """
+        processed = 0
+        for k, grid_id in enumerate(grid_ids):
+            seq = start + k + 1
+            try:
+                if not self.show_grid(grid_id):
+                    print(f"[{seq}] 格网 {grid_id} 展示超时，停止该段")
+                    break
+                label, label_name = self.predict_label(grid_id)
+                if label == 0:
+                    print(f"[{seq}] 格网 {grid_id} → 无法判断，跳过")
+                    processed += 1
+                    continue
+                if not self.post_label(grid_id, label):
+                    print(f"[{seq}] 格网 {grid_id} 标签提交失败，停止该段")
+                    break
+                self.take_screenshot(seq, grid_id, label, label_name)
+                print(f"[{seq}] 格网 {grid_id} → {label} ({label_name})")
+                processed += 1
+            except Exception as e:
+                print(f"[{seq}] 格网 {grid_id} ✗ 失败: {e}")
+                break
+        return processed
 
     def close(self):
         """关闭浏览器"""
         self.driver.quit()
 
 
+def run_parallel(count: int, workers: int):
+    """
+    多浏览器并行标注：先取出队列，按连续区间分给 workers 个无界面浏览器，
+    各自直接定位格网并提交标签；全部结束后把服务器队列指针移到已连续完成的位置
+    """
+    import requests
+    from concurrent.futures import ThreadPoolExecutor
+
+    queue_info = _json_loads(requests.get(f"{BASE_URL}/api/label_queue", timeout=10).content)
+    queue = queue_info.get("queue", [])
+    index = queue_info.get("index", 0)
+    grid_ids = queue[index:index + count]
+    if not grid_ids:
+        print("队列为空，请先在网页上点击'开始打标签'")
+        return
+
+    # 上一轮中断时，指针之后可能已有其他浏览器标好的格网：跳过它们，避免重复写入 labels.csv
+    labeled = {r["grid_id"] for r in _json_loads(requests.get(f"{BASE_URL}/api/labels", timeout=30).content)}
+    todo = [(pos, gid) for pos, gid in enumerate(grid_ids) if gid not in labeled]
+    if len(todo) < len(grid_ids):
+        print(f"跳过 {len(grid_ids) - len(todo)} 个已有标签的格网")
+
+    done = set(range(len(grid_ids))) - {pos for pos, _ in todo}
+    parts = []
+    if todo:
+        workers = max(1, min(workers, len(todo)))
+        size = math.ceil(len(todo) / workers)
+        parts = [todo[s:s + size] for s in range(0, len(todo), size)]
+    print(f"=== 并行标注开始：{len(todo)} 个格网，{len(parts)} 个浏览器 ===\n")
+
+    def work(part):
+        # 任何异常都只结束本段，返回已连续完成的数量，保证最后仍会提交队列指针
+        labeler = None
+        try:
+            labeler = SeleniumAutoLabeler(headless=True)
+            labeler.open_page()
+            return labeler.run_range([gid for _, gid in part], part[0][0])
+        except Exception as e:
+            print(f"浏览器启动或运行失败（段起点 {part[0][0] + 1}）: {e}")
+            return 0
+        finally:
+            if labeler is not None:
+                labeler.close()
+
+    results = []
+    if parts:
+        with ThreadPoolExecutor(max_workers=len(parts)) as executor:
+            results = list(executor.map(work, parts))
+    for part, n in zip(parts, results):
+        done.update(pos for pos, _ in part[:n])
+
+    # 队列指针前进到第一个未完成的位置；其后已完成的格网有了标签，下一轮会被跳过
+    advanced = 0
+    while advanced < len(grid_ids) and advanced in done:
+        advanced += 1
+    resp = requests.post(f"{BASE_URL}/api/label_batch",
+                         json={"labels": [], "advance_to": index + advanced}, timeout=10)
+    resp.raise_for_status()
+    print(f"\n=== 并行标注完成：处理 {sum(results)}/{len(todo)}，队列前进 {advanced} ===")
+
+
 def main():
     import sys
 
     count = 100
     if len(sys.argv) > 1:
         count = int(sys.argv[1])
+    workers = 1
+    if len(sys.argv) > 2:
+        workers = int(sys.argv[2])
+
+    if workers > 1:
+        run_parallel(count, workers)  # 无界面并行模式
+        return
 
     labeler = SeleniumAutoLabeler(headless=False)  # 设置为True可以在后台运行
 
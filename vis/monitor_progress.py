@@ -4,6 +4,8 @@
 """
 
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import time
 
 def monitor_progress(refresh_interval=5):
@@ -12,12 +14,17 @@ def monitor_progress(refresh_interval=5):
     print(f"刷新间隔: {refresh_interval}秒")
     print("按 Ctrl+C 停止\n")
 
+    # 复用同一个长连接；服务器短暂出错时自动退避重试，而不是直接退出监控
+    sess = requests.Session()
+    sess.mount('http://', HTTPAdapter(max_retries=Retry(total=3, backoff_factor=0.3,
+                                                        status_forcelist=[502, 503, 504])))
+
     last_index = 0
     start_time = time.time()
 
     try:
         while True:
-            resp = requests.get('http://127.0.0.1:8055/api/label_queue')
+            resp = sess.get('http://127.0.0.1:8055/api/label_queue', timeout=5)
             data = resp.json()
 
             queue = data.get('queue', [])
@@ -50,6 +57,8 @@ def monitor_progress(refresh_interval=5):
         print("\n\n监控已停止")
     except Exception as e:
         print(f"\n错误: {e}")
+    finally:
+        sess.close()
 
 if __name__ == "__main__":
     import sys
@@ -1,15 +1,26 @@
 #!/usr/bin/env python3
 import os
 import sys
+import io
 import csv
+import locale
 import json
 import time
 import random
+import gzip
+import atexit
+import weakref
+import hashlib
+import functools
 import argparse
+import shutil
+import tempfile
 from pathlib import Path
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
 from typing import Dict, List, Tuple
 
-from flask import Flask, jsonify, request, send_file, send_from_directory, render_template
+from flask import Flask, Response, jsonify, request, send_file, send_from_directory, render_template
 try:
     from flask_compress import Compress  # type: ignore
 except Exception:
@@ -22,6 +33,23 @@ try:
 except Exception as e:
     duckdb = None
 
+try:
+    import numpy as np  # type: ignore
+except Exception:
+    np = None  # optional: heat falls back to a per-row Python loop
+
+try:
+    import pyarrow as pa  # type: ignore
+    import pyarrow.parquet as pq  # type: ignore
+    import pyarrow.csv as pacsv  # type: ignore
+except Exception:
+    pa = pq = pacsv = None  # optional: ?format=arrow is unavailable without it
+
+try:
+    import orjson  # type: ignore
+except Exception:
+    orjson = None  # optional: large payloads fall back to jsonify
+
 
 ROOT = Path(__file__).resolve().parent
 DATA_DIR = ROOT / "data"
@@ -32,11 +60,33 @@ STATIC_DIR = ROOT / "static"
 
 
 YEARS = [2018, 2021, 2024]
+HOURLY_BULK_MAX = 1000  # max grid ids per /api/hourly_bulk request
+DUCKDB_THREADS = os.cpu_count() or 4
+DUCKDB_MEMORY_LIMIT = "4GB"
+SHOT_DECODE_CHUNK = 64 * 1024  # base64 chars decoded per write in /api/screenshot (multiple of 4)
+HEAT_CACHE_SIZE = 256  # cached /api/heat payloads, keyed by (year, metric, city, area, format)
+LABELS_ENCODING = locale.getpreferredencoding(False)  # what open() uses for labels.csv in text mode
+LABEL_FLUSH_DELAY = 0.2  # seconds a saved label may wait in memory before labels.csv is appended
+LABEL_FLUSH_MAX = 256  # pending labels that force an immediate flush
+LABEL_FLUSH_RETRY = 5.0  # seconds before a failed background flush of buffered labels is retried
+LABEL_FSYNC_EVERY = 64  # appended labels between fdatasync calls on labels.csv
+EDGES_PARTITIONS = 256  # edges parquet is hive-partitioned by grid_id % EDGES_PARTITIONS
+RDP_NUMPY_MIN = 8  # rings shorter than this are simplified with the scalar Douglas-Peucker
 
 
 def _ensure_dirs():
     APPDATA_DIR.mkdir(parents=True, exist_ok=True)
     LABELS_DIR.mkdir(parents=True, exist_ok=True)
+    _seed_labels_csv(LABELS_DIR / "labels.csv")
+
+
+def _seed_labels_csv(path: Path):
+    """Create labels.csv with just its header if it is missing (exclusive create: never truncates)."""
+    try:
+        with path.open("x", newline="") as f:
+            csv.writer(f).writerow(["grid_id", "lon", "lat", "label", "remark"])
+    except FileExistsError:
+        pass
 
 
 def detect_cols(csv_path: Path) -> Dict[str, str]:
@@ -64,55 +114,278 @@ def detect_cols(csv_path: Path) -> Dict[str, str]:
     return mapping
 
 
+def _metadata_sql(meta_csv: Path):
+    """SELECT over the metadata CSV (path bound to `?`) keeping rows with an integer grid_id and numeric lon/lat.
+
+    Returns None when a required column is missing.
+    """
+    with meta_csv.open("r", newline="", encoding="utf-8-sig") as f:
+        header = next(csv.reader(f), [])
+    # Expected: grid_id, lon, lat; optional: area_name, city_name
+    if not {"grid_id", "lon", "lat"} <= set(header):
+        return None
+    area = "COALESCE(area_name, '')" if "area_name" in header else "''"
+    city = "COALESCE(city_name, '')" if "city_name" in header else "''"
+    return f"""
+        SELECT TRY_CAST(trim(grid_id) AS BIGINT) AS grid_id,
+               TRY_CAST(trim(lon) AS DOUBLE) AS lon,
+               TRY_CAST(trim(lat) AS DOUBLE) AS lat,
+               {area} AS area_name,
+               {city} AS city_name
+        FROM read_csv(?, header=true, all_varchar=true, null_padding=true)
+        WHERE regexp_matches(grid_id, '^\\s*[+-]?\\d+\\s*$')
+          AND TRY_CAST(trim(lon) AS DOUBLE) IS NOT NULL
+          AND TRY_CAST(trim(lat) AS DOUBLE) IS NOT NULL
+    """
+
+
 def load_metadata(meta_csv: Path) -> Tuple[List[Dict], Dict[int, Dict]]:
-    items: List[Dict] = []
-    by_id: Dict[int, Dict] = {}
-    with meta_csv.open("r", newline="") as f:
-        reader = csv.DictReader(f)
-        # Expected: grid_id, lon, lat; optional: area_name, city_name
-        for row in reader:
-            try:
-                gid = int(row["grid_id"])  # type: ignore
-                lon = float(row["lon"])  # type: ignore
-                lat = float(row["lat"])  # type: ignore
-            except Exception:
-                continue
-            item = {
-                "grid_id": gid,
-                "lon": lon,
-                "lat": lat,
-                "area_name": row.get("area_name", ""),
-                "city_name": row.get("city_name", ""),
-            }
-            items.append(item)
-            by_id[gid] = item
+    sql = _metadata_sql(meta_csv)
+    if sql is None:
+        return [], {}
+    # parsed and type-checked by DuckDB in one pass instead of a per-row DictReader loop
+    with duckdb.connect() as con:
+        rows = con.execute(sql, [str(meta_csv)]).fetchall()
+    items: List[Dict] = [
+        {"grid_id": gid, "lon": lon, "lat": lat, "area_name": area, "city_name": city}
+        for gid, lon, lat, area, city in rows
+    ]
+    by_id: Dict[int, Dict] = {item["grid_id"]: item for item in items}
     return items, by_id
 
 
+def _flows_sql(view: str, key: str, other: str, with_total: bool) -> str:
+    """Top-k ($2) edges of one grid ($1) by num_total; with_total adds the grid's total flow as a third column."""
+    where = f"{key} = $1 AND part = $1 % {EDGES_PARTITIONS}"
+    total = f", (SELECT SUM(num_total) FROM {view} WHERE {where}) AS tot" if with_total else ""
+    return f"SELECT {other}, num_total{total} FROM {view} WHERE {where} ORDER BY num_total DESC LIMIT $2"
+
+
+def _low_traffic_sql(view: str, use_pool: bool) -> str:
+    """grid_ids whose mean hourly total (the hourly_avg view) is <= $1 in at least a $2 share of the 24 hours.
+
+    use_pool restricts (and completes) the grids to the `pool` table/view, else they come from the data.
+    """
+    if use_pool:
+        base = f"""
+          base AS (
+            SELECT a.grid_id, a.hour, a.avg_total
+            FROM {view} a JOIN pool p ON a.grid_id = p.gid
+          ), gids AS (
+            SELECT gid AS grid_id FROM pool
+          )"""
+    else:
+        base = f"""
+          base AS (
+            SELECT grid_id, hour, avg_total FROM {view}
+          ), gids AS (
+            SELECT DISTINCT grid_id FROM base
+          )"""
+    return f"""
+        WITH {base}, hrs AS (
+          SELECT range AS hour FROM range(0,24)
+        ), full24 AS (
+          SELECT g.grid_id, h.hour FROM gids g CROSS JOIN hrs h
+        ), h AS (
+          SELECT f.grid_id, f.hour, COALESCE(b.avg_total, 0) AS avg_total
+          FROM full24 f LEFT JOIN base b USING (grid_id, hour)
+        ), zr AS (
+          SELECT grid_id,
+            SUM(CASE WHEN avg_total <= $1 THEN 1 ELSE 0 END)::DOUBLE / 24.0 AS low_ratio
+          FROM h
+          GROUP BY grid_id
+        )
+        SELECT grid_id FROM zr WHERE low_ratio >= $2
+    """
+
+
+def _json_dumps(obj) -> bytes:
+    """UTF-8 JSON for the small state files (queue, bounds cache); orjson when installed."""
+    if orjson is not None:
+        return orjson.dumps(obj)
+    return json.dumps(obj, ensure_ascii=False).encode("utf-8")
+
+
+def _atomic_write_bytes(path: Path, data: bytes):
+    """Replace path with data via a synced temp file in the same directory: readers see old or new, never half."""
+    fd, tmp = tempfile.mkstemp(dir=str(path.parent), prefix=path.name + ".", suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, path)
+    except BaseException:
+        Path(tmp).unlink(missing_ok=True)
+        raise
+
+
+def _json_load(path: Path):
+    """Parse a JSON file written by _json_dumps (or by an older text-mode json.dumps)."""
+    data = path.read_bytes()
+    if orjson is not None:
+        try:
+            return orjson.loads(data)
+        except orjson.JSONDecodeError:
+            pass  # not UTF-8 / not strict JSON: older files written in the locale encoding
+    return json.loads(path.read_text())
+
+
+def _json_response(obj) -> Response:
+    """jsonify() for large payloads: orjson encodes several times faster when installed."""
+    if orjson is None:
+        return jsonify(obj)
+    return Response(orjson.dumps(obj, option=orjson.OPT_SERIALIZE_NUMPY), mimetype="application/json")
+
+
+def _encode_payload(resp: Response) -> Tuple[bytes, bytes, str, str]:
+    """Body, gzip copy, ETag and mimetype of a response, for serving it again without re-encoding."""
+    body = resp.get_data()
+    etag = hashlib.blake2b(body, digest_size=8).hexdigest()
+    return body, gzip.compress(body, compresslevel=6), etag, resp.mimetype
+
+
+def _encoded_response(body: bytes, gz: bytes, etag: str, mimetype: str) -> Response:
+    """Serve an _encode_payload() result: 304 on a matching ETag, the gzip copy when accepted."""
+    if etag in request.if_none_match:
+        resp = Response(status=304)
+    elif "gzip" in request.accept_encodings:
+        # already compressed once per cache entry; Flask-Compress leaves encoded responses alone
+        resp = Response(gz, mimetype=mimetype)
+        resp.headers["Content-Encoding"] = "gzip"
+    else:
+        resp = Response(body, mimetype=mimetype)
+    resp.headers["Vary"] = "Accept-Encoding"
+    resp.set_etag(etag)
+    return resp
+
+
+def _arrow_response(columns: Dict[str, object], meta: Dict[str, object] = None) -> Response:
+    """Columns as a single Arrow IPC stream; scalar extras go into the schema metadata."""
+    table = pa.table(columns)
+    if meta:
+        table = table.replace_schema_metadata({k: str(v) for k, v in meta.items()})
+    sink = pa.BufferOutputStream()
+    with pa.ipc.new_stream(sink, table.schema) as writer:
+        writer.write_table(table)
+    return Response(sink.getvalue().to_pybytes(), mimetype="application/vnd.apache.arrow.stream")
+
+
+def _flows_arrow_columns(flows: Dict[int, Dict]) -> Dict[str, object]:
+    """Flatten {year: flows_for_grid(...)} into edge columns with both endpoints' coordinates."""
+    cols: Dict[str, list] = {k: [] for k in ("year", "direction", "o_grid", "d_grid", "num_total", "o_lon", "o_lat", "d_lon", "d_lat")}
+    for y, data in flows.items():
+        for direction, edges in (("out", data["out_edges"]), ("in", data["in_edges"])):
+            for e in edges:
+                cols["year"].append(int(y))
+                cols["direction"].append(direction)
+                cols["o_grid"].append(e["o_grid"])
+                cols["d_grid"].append(e["d_grid"])
+                cols["num_total"].append(e["num_total"])
+                o, d = e["o"] or {}, e["d"] or {}
+                cols["o_lon"].append(o.get("lon"))
+                cols["o_lat"].append(o.get("lat"))
+                cols["d_lon"].append(d.get("lon"))
+                cols["d_lat"].append(d.get("lat"))
+    return {
+        "year": pa.array(cols["year"], type=pa.int16()),
+        "direction": pa.array(cols["direction"], type=pa.string()),
+        "o_grid": pa.array(cols["o_grid"], type=pa.int64()),
+        "d_grid": pa.array(cols["d_grid"], type=pa.int64()),
+        "num_total": pa.array(cols["num_total"], type=pa.float64()),
+        **{k: pa.array(cols[k], type=pa.float64()) for k in ("o_lon", "o_lat", "d_lon", "d_lat")},
+    }
+
+
+def _group_rows(labels) -> Tuple[Dict[str, object], object]:
+    """(label -> ascending row indices holding it, int32 label code per row); codes follow the dict order."""
+    if len(labels) == 0:
+        return {}, np.zeros(0, dtype=np.int32)
+    keys, inverse = np.unique(labels, return_inverse=True)
+    order = np.argsort(inverse, kind="stable")
+    bounds = np.cumsum(np.bincount(inverse, minlength=len(keys)))[:-1]
+    groups = {k: idx.astype(np.int64) for k, idx in zip(keys.tolist(), np.split(order, bounds))}
+    return groups, inverse.astype(np.int32)
+
+
 class DataEngine:
     def __init__(self, data_dir: Path, appdata_dir: Path, meta_path: Path, require_csv: bool = True):
         if duckdb is None:
             raise RuntimeError("duckdb is required. Please pip install duckdb")
         self.data_dir = data_dir
         self.appdata_dir = appdata_dir
+        self.meta_path = meta_path
         self.meta_items, self.meta_by_id = load_metadata(meta_path)
+        self._build_meta_arrays()
         self.year_paths = {y: data_dir / f"{y}.csv" for y in YEARS}
+        # headers are only parsed when a year is actually built (see _colmap)
         self.year_colmaps: Dict[int, Dict[str, str]] = {}
         if require_csv:
             for y, p in self.year_paths.items():
                 if not p.exists():
                     raise FileNotFoundError(f"Missing data file: {p}")
-                self.year_colmaps[y] = detect_cols(p)
-        else:
-            # Parquet-only mode: CSVs are optional; allow building only if files provided later.
-            for y, p in self.year_paths.items():
-                if p.exists():
-                    self.year_colmaps[y] = detect_cols(p)
+        # Parquet-only mode: CSVs are optional; allow building only if files provided later.
+        # one long-lived in-memory connection; requests use cheap cursors on it instead of duckdb.connect()
+        self.con = duckdb.connect()
+        # settings are per database, so every cursor inherits them; object cache keeps parquet footers between requests
+        for pragma in (f"PRAGMA threads={DUCKDB_THREADS}",
+                       "PRAGMA enable_object_cache=true",
+                       f"PRAGMA memory_limit='{DUCKDB_MEMORY_LIMIT}'"):
+            try:
+                self.con.execute(pragma)
+            except Exception:
+                pass
+
+        self._attached_edges: Dict[int, str] = {}  # year -> alias of attached edges_{y}.duckdb
+        self._totals_cache: Dict[int, Tuple[float, Dict]] = {}  # year -> (parquet mtime, column arrays)
+        self._attach_lock = threading.Lock()
+        self._edges_views = set()  # years whose edges_o_{y}/edges_d_{y} views exist
+        self._parquet_views = set()  # (kind, year) whose {kind}_{year} view exists
+        self._weeks_cache: Dict[int, Tuple[float, List[int]]] = {}  # year -> (hourly parquet mtime, weeks)
+        self._avg_cache: Dict[int, Tuple[float, Tuple]] = {}  # year -> (hourly_avg mtime, (grid_ids, [n, 24] means))
+        self._avg_lock = threading.Lock()
+        self._meta_table = False  # DuckDB table `meta` loaded
+        # reusable cursors, each with the flows statements it has already PREPAREd
+        self._cursor_pool: List[Tuple[object, set]] = []
+        self._pool_lock = threading.Lock()
+
+    def cursor(self):
+        """Per-call cursor on the shared connection (safe to use from Flask's worker threads)."""
+        return self.con.cursor()
+
+    @contextmanager
+    def _pooled_cursor(self):
+        """Borrow a long-lived cursor (with its prepared statements) from the pool."""
+        with self._pool_lock:
+            entry = self._cursor_pool.pop() if self._cursor_pool else None
+        if entry is None:
+            entry = (self.con.cursor(), set())
+        try:
+            yield entry
+        finally:
+            with self._pool_lock:
+                self._cursor_pool.append(entry)
 
     def _parquet_path(self, kind: str, year: int) -> Path:
-        # kind in {edges_by_o, edges_by_d, hourly}
+        # kind in {edges_by_o, edges_by_d, hourly, hourly_avg, totals}
+        # edges are directories edges_by_o_{y}/o_mod=N/*.parquet; single-file builds from before are still read
+        if kind in ("edges_by_o", "edges_by_d"):
+            legacy = self.appdata_dir / f"{kind}_{year}.parquet"
+            d = self._edges_dir(kind, year)
+            return legacy if legacy.exists() and not d.exists() else d
         return self.appdata_dir / f"{kind}_{year}.parquet"
 
+    def _edges_dir(self, kind: str, year: int) -> Path:
+        return self.appdata_dir / f"{kind}_{year}"
+
+    def _parquet_source(self, kind: str, year: int) -> str:
+        """read_parquet() argument for kind/year: the file, or a glob over the partition directory."""
+        p = self._parquet_path(kind, year)
+        return str(p / "*" / "*.parquet") if p.is_dir() else str(p)
+
+    def _edges_db_path(self, year: int) -> Path:
+        return self.appdata_dir / f"edges_{year}.duckdb"
+
     def ensure_built(self, years: List[int] = YEARS):
         for y in years:
             need_edges_o = not self._parquet_path("edges_by_o", y).exists()
@@ -120,6 +393,216 @@ class DataEngine:
             need_hourly = not self._parquet_path("hourly", y).exists()
             if need_edges_o or need_edges_d or need_hourly:
                 self._build_year(y, build_edges_o=need_edges_o, build_edges_d=need_edges_d, build_hourly=need_hourly)
+            elif not self._edges_db_path(y).exists():
+                self.build_edges_db_for_year(y)
+
+    def build_edges_db_for_year(self, y: int):
+        """(Re)build edges_{y}.duckdb: native tables sorted by o_grid/d_grid with ART indexes for point lookups."""
+        if not self._parquet_path("edges_by_o", y).exists() or not self._parquet_path("edges_by_d", y).exists():
+            return
+        p_out = self._parquet_source("edges_by_o", y)
+        p_in = self._parquet_source("edges_by_d", y)
+        db_p = self._edges_db_path(y)
+        tmp_p = db_p.with_name(db_p.name + ".tmp")
+        tmp_p.unlink(missing_ok=True)
+        print(f"[build] year {y}: writing {db_p} ...", flush=True)
+        with duckdb.connect(str(tmp_p)) as con:
+            con.execute("CREATE TABLE edges_o AS SELECT o_grid, d_grid, num_total FROM read_parquet(?) ORDER BY o_grid", [p_out])
+            con.execute("CREATE INDEX idx_edges_o ON edges_o(o_grid)")
+            con.execute("CREATE TABLE edges_d AS SELECT o_grid, d_grid, num_total FROM read_parquet(?) ORDER BY d_grid", [p_in])
+            con.execute("CREATE INDEX idx_edges_d ON edges_d(d_grid)")
+        with self._attach_lock:
+            alias = self._attached_edges.pop(y, None)
+            if alias:
+                try:
+                    self.con.execute(f"DETACH DATABASE IF EXISTS {alias}")
+                except Exception:
+                    pass
+            os.replace(tmp_p, db_p)
+            if y in self._edges_views:
+                # re-point the views at the new file; prepared statements rebind on next EXECUTE
+                self._create_edges_views(y)
+
+    def _edges_view(self, year: int, kind: str) -> str:
+        """Shared view name over the edges for (year, kind), created on first use."""
+        if year not in self._edges_views:
+            with self._attach_lock:
+                if year not in self._edges_views:
+                    self._create_edges_views(year)
+        return f"{'edges_o' if kind == 'edges_by_o' else 'edges_d'}_{year}"
+
+    def _create_edges_views(self, year: int):
+        # caller holds _attach_lock; prefer the indexed edges_{y}.duckdb, else the parquet files
+        alias = self._attached_edges.get(year)
+        if alias is None and self._edges_db_path(year).exists():
+            try:
+                alias = f"edges_{year}"
+                self.con.execute(f"ATTACH '{self._edges_db_path(year)}' AS {alias} (READ_ONLY)")
+                self._attached_edges[year] = alias
+            except Exception:
+                alias = None
+        # every view exposes `part` (key % EDGES_PARTITIONS) so the flows filter on it lets
+        # DuckDB skip all but one partition directory when reading parquet
+        for kind, table in (("edges_by_o", "edges_o"), ("edges_by_d", "edges_d")):
+            key = "o_grid" if kind == "edges_by_o" else "d_grid"
+            part = f"{key} % {EDGES_PARTITIONS}"
+            if alias:
+                src = f"{alias}.{table}"
+            else:
+                escaped = self._parquet_source(kind, year).replace("'", "''")
+                if self._parquet_path(kind, year).is_dir():
+                    src, part = f"read_parquet('{escaped}', hive_partitioning=true)", f"{key[0]}_mod"
+                else:
+                    src = f"read_parquet('{escaped}')"
+            self.con.execute(
+                f"CREATE OR REPLACE VIEW {table}_{year} AS SELECT o_grid, d_grid, num_total, {part} AS part FROM {src}"
+            )
+        self._edges_views.add(year)
+
+    def _flows_rows(self, year: int, kind: str, grid_id: int, topk: int, cov: float) -> List[Tuple]:
+        """Top edges of one grid via a per-cursor prepared statement on the edges view."""
+        view = self._edges_view(year, kind)
+        key, other = ("o_grid", "d_grid") if kind == "edges_by_o" else ("d_grid", "o_grid")
+        name = f"flows_{view}_{int(cov > 0.0)}"
+        with self._pooled_cursor() as (con, prepared):
+            if name not in prepared:
+                con.execute(f"PREPARE {name} AS {_flows_sql(view, key, other, cov > 0.0)}")
+                prepared.add(name)
+            # EXECUTE takes literals; every argument is a number coerced here
+            rows = con.execute(f"EXECUTE {name}({int(grid_id)}, {int(topk)})").fetchall()
+        if cov <= 0.0 or not rows:
+            return rows
+        # coverage: the top-k come from DuckDB's heap Top-N, so only these rows need a running sum;
+        # the edges kept are a prefix of them (num_total >= 0), no sort of the whole distribution
+        limit = cov * rows[0][2]
+        out, cs = [], 0.0
+        for o, v, _ in rows:
+            cs += v
+            if cs > limit:
+                break
+            out.append((o, v))
+        return out
+
+    def _parquet_view(self, kind: str, year: int) -> str:
+        """Shared view {kind}_{year} over a single-file parquet (hourly, hourly_avg), created on first use."""
+        if (kind, year) not in self._parquet_views:
+            with self._attach_lock:
+                if (kind, year) not in self._parquet_views:
+                    escaped = str(self._parquet_path(kind, year)).replace("'", "''")
+                    self.con.execute(f"CREATE OR REPLACE VIEW {kind}_{year} AS SELECT * FROM read_parquet('{escaped}')")
+                    self._parquet_views.add((kind, year))
+        return f"{kind}_{year}"
+
+    def hourly_weeks(self, year: int) -> List[int]:
+        """Distinct weeks of hourly_{year}.parquet, cached until the file changes."""
+        mtime = self._parquet_path("hourly", year).stat().st_mtime
+        hit = self._weeks_cache.get(year)
+        if hit is not None and hit[0] == mtime:
+            return hit[1]
+        view = self._parquet_view("hourly", year)
+        with self._pooled_cursor() as (con, _):
+            weeks = [int(r[0]) for r in con.execute(f"SELECT DISTINCT week FROM {view} ORDER BY week").fetchall()]
+        self._weeks_cache[year] = (mtime, weeks)
+        return weeks
+
+    def ensure_hourly_avg(self, year: int) -> Path:
+        """hourly_avg_{year}.parquet: mean total per (grid_id, hour) over all weeks, rebuilt when hourly_{year} changes."""
+        p = self._parquet_path("hourly_avg", year)
+        src = self._parquet_path("hourly", year)
+        with self._avg_lock:
+            if p.exists() and p.stat().st_mtime >= src.stat().st_mtime:
+                return p
+            view = self._parquet_view("hourly", year)
+            tmp = p.with_suffix(".parquet.tmp")
+            with self.cursor() as con:
+                con.execute(f"""
+                    COPY (
+                      SELECT grid_id, hour, COALESCE(AVG(total), 0) AS avg_total
+                      FROM {view}
+                      WHERE week IS NOT NULL
+                      GROUP BY grid_id, hour
+                      ORDER BY grid_id, hour
+                    ) TO '{tmp}' (FORMAT PARQUET)
+                """)
+            os.replace(tmp, p)
+        return p
+
+    def hourly_avg_arrays(self, year: int) -> Tuple:
+        """(sorted grid_ids, [n, 24] float64 means) from hourly_avg_{year}; hours without rows are 0."""
+        p = self.ensure_hourly_avg(year)
+        mtime = p.stat().st_mtime
+        cached = self._avg_cache.get(year)
+        if cached and cached[0] == mtime:
+            return cached[1]
+        if pq is not None:
+            table = pq.read_table(str(p), columns=["grid_id", "hour", "avg_total"])
+            cols = {c: table.column(c).to_numpy() for c in table.column_names}
+        else:
+            with self.cursor() as con:
+                cols = con.execute("SELECT grid_id, hour, avg_total FROM read_parquet(?)", [str(p)]).fetchnumpy()
+        hour = np.asarray(cols["hour"], dtype=np.int64)
+        ok = (hour >= 0) & (hour < 24)
+        gids, row = np.unique(np.asarray(cols["grid_id"], dtype=np.int64)[ok], return_inverse=True)
+        avg = np.zeros((len(gids), 24), dtype=np.float64)
+        avg[row, hour[ok]] = np.asarray(cols["avg_total"], dtype=np.float64)[ok]
+        self._avg_cache[year] = (mtime, (gids, avg))
+        return gids, avg
+
+    def hourly_avg_row(self, year: int, grid_id: int) -> List[float]:
+        """The 24 hourly means of one grid from hourly_avg_{year} (0 for hours without data)."""
+        if np is not None:
+            gids, avg = self.hourly_avg_arrays(year)
+            i = int(np.searchsorted(gids, grid_id))
+            return avg[i].tolist() if i < len(gids) and gids[i] == grid_id else [0.0] * 24
+        self.ensure_hourly_avg(year)
+        view = self._parquet_view("hourly_avg", year)
+        out = [0.0] * 24
+        with self._pooled_cursor() as (con, _):
+            sql = f"SELECT hour, avg_total FROM {view} WHERE grid_id = ? AND hour >= 0 AND hour < 24"
+            for hour, v in con.execute(sql, [int(grid_id)]).fetchall():
+                out[int(hour)] = float(v)
+        return out
+
+    def low_traffic_keep(self, year: int, pool: List[int], low_value: float, low_ratio: float) -> List[int]:
+        """The grid_ids of `pool`, in order, that are NOT low-traffic (see _low_traffic_sql) in `year`."""
+        if np is not None:
+            # lookup in the materialised 24h means: a grid with no hourly rows counts as 24 zero hours
+            gids, avg = self.hourly_avg_arrays(year)
+            ids = np.asarray(pool, dtype=np.int64)
+            cnt = np.full(len(ids), 24 if 0 <= low_value else 0, dtype=np.int64)
+            if len(gids):
+                pos = np.minimum(np.searchsorted(gids, ids), len(gids) - 1)
+                found = gids[pos] == ids
+                cnt[found] = (avg[pos[found]] <= low_value).sum(axis=1)
+            # the kept ids come straight out of the mask: no set of dropped ids, no Python pass over the pool
+            return ids[~(cnt / 24.0 >= low_ratio)].tolist()
+        self.ensure_hourly_avg(year)
+        view = self._parquet_view("hourly_avg", year)
+        with self._pooled_cursor() as (con, prepared):
+            # Ensure pool grid_ids are considered even if they never appear in hourly parquet
+            use_pool = True
+            try:
+                if pa is not None:
+                    # one zero-copy Arrow view instead of a row-by-row INSERT
+                    con.register("pool", pa.table({"gid": pa.array(pool, type=pa.int64())}))
+                else:
+                    con.execute("DROP TABLE IF EXISTS pool")
+                    con.execute("CREATE TEMPORARY TABLE pool(gid BIGINT)")
+                    con.executemany("INSERT INTO pool (gid) VALUES (?)", [(int(g),) for g in pool])
+            except Exception:
+                use_pool = False
+            name = f"low_{view}_{int(use_pool)}"
+            try:
+                if name not in prepared:
+                    con.execute(f"PREPARE {name} AS {_low_traffic_sql(view, use_pool)}")
+                    prepared.add(name)
+                # EXECUTE takes literals; quoted so inf/nan cast like bound parameters would
+                rows = con.execute(f"EXECUTE {name}('{float(low_value)!r}'::DOUBLE, '{float(low_ratio)!r}'::DOUBLE)").fetchall()
+            finally:
+                if use_pool and pa is not None:
+                    con.unregister("pool")
+        bad_set = {int(r[0]) for r in rows}
+        return [gid for gid in pool if gid not in bad_set]
 
     def build_totals_for_year(self, y: int):
         """(Re)build totals_{y}.parquet from edges_by_o/d parquet (fast)."""
@@ -129,19 +612,20 @@ class DataEngine:
             # fall back to full build (will read CSV)
             self._build_year(y, build_edges_o=not p_out.exists(), build_edges_d=not p_in.exists(), build_hourly=False)
         totals_p = self._parquet_path("totals", y)
-        with duckdb.connect() as con:
+        p_out, p_in = self._parquet_source("edges_by_o", y), self._parquet_source("edges_by_d", y)
+        with self.cursor() as con:
             con.execute(
                 f"""
                 CREATE OR REPLACE TEMP VIEW gout AS
                 SELECT o_grid AS grid_id, SUM(num_total) AS out_total
-                FROM read_parquet('{str(p_out)}') GROUP BY o_grid
+                FROM read_parquet('{p_out}') GROUP BY o_grid
                 """
             )
             con.execute(
                 f"""
                 CREATE OR REPLACE TEMP VIEW gin AS
                 SELECT d_grid AS grid_id, SUM(num_total) AS in_total
-                FROM read_parquet('{str(p_in)}') GROUP BY d_grid
+                FROM read_parquet('{p_in}') GROUP BY d_grid
                 """
             )
             con.execute(
@@ -159,12 +643,98 @@ class DataEngine:
             except Exception:
                 pass
             con.execute(
-                f"COPY (SELECT * FROM gt ORDER BY grid_id) TO '{str(totals_p)}' (FORMAT PARQUET, COMPRESSION ZSTD)"
+                f"COPY (SELECT * FROM gt ORDER BY grid_id) TO '{str(totals_p)}' (FORMAT PARQUET, COMPRESSION UNCOMPRESSED)"
             )
 
+    def totals_arrays(self, year: int) -> Dict:
+        """totals_{year} as NumPy columns (rows without metadata dropped) plus row indices per city/area.
+
+        Cached in memory and reloaded when the parquet file changes.
+        """
+        p = self._parquet_path("totals", year)
+        mtime = p.stat().st_mtime
+        cached = self._totals_cache.get(year)
+        if cached and cached[0] == mtime:
+            return cached[1]
+        if pq is not None:
+            # plain column read, no query to plan: pyarrow straight into NumPy
+            table = pq.read_table(str(p), columns=["grid_id", "out_total", "in_total", "total"])
+            cols = {c: table.column(c).to_numpy() for c in table.column_names}
+        else:
+            with self.cursor() as con:
+                cols = con.execute(
+                    "SELECT grid_id, out_total, in_total, total FROM read_parquet(?)", [str(p)]
+                ).fetchnumpy()
+        gid = np.asarray(cols["grid_id"], dtype=np.int64)
+        rows = np.fromiter((self.meta_idx.get(g, -1) for g in gid.tolist()), dtype=np.int64, count=len(gid))
+        keep = rows >= 0
+        rows = rows[keep]
+        data = {
+            "grid_id": gid[keep],
+            "out": np.asarray(cols["out_total"], dtype=np.float64)[keep],
+            "in": np.asarray(cols["in_total"], dtype=np.float64)[keep],
+            "total": np.asarray(cols["total"], dtype=np.float64)[keep],
+        }
+        data["city_idx"], data["city_code"] = _group_rows(self.meta_city[rows])
+        data["area_idx"], data["area_code"] = _group_rows(self.meta_area[rows])
+        data["area_codes"] = {k: i for i, k in enumerate(data["area_idx"])}
+        self._totals_cache[year] = (mtime, data)
+        return data
+
+    def _build_meta_arrays(self):
+        """Column arrays aligned with meta_items plus grid_id -> row, for vectorised city/area filters."""
+        items = self.meta_items
+        # lowercased "city area" for the label-queue keyword filter, built once instead of per request
+        self.meta_search = [f"{m.get('city_name','')} {m.get('area_name','')}".lower() for m in items]
+        if np is None:
+            self.meta_idx = None
+            return
+        self.meta_gids = np.fromiter((m["grid_id"] for m in items), dtype=np.int64, count=len(items))
+        self.meta_lon = np.fromiter((m["lon"] for m in items), dtype=np.float64, count=len(items))
+        self.meta_lat = np.fromiter((m["lat"] for m in items), dtype=np.float64, count=len(items))
+        self.meta_city = np.array([m.get("city_name") or "" for m in items], dtype=object)
+        self.meta_area = np.array([m.get("area_name") or "" for m in items], dtype=object)
+        self.meta_text = np.array(self.meta_search, dtype=str)
+        # last row wins for duplicated ids, same as meta_by_id
+        self.meta_idx = {g: i for i, g in enumerate(self.meta_gids.tolist())}
+
+    def meta_mask(self, city: str = "", area: str = ""):
+        """Boolean mask over meta_items for the given city/area filters (empty = no filter)."""
+        mask = np.ones(len(self.meta_items), dtype=bool)
+        if city:
+            mask &= self.meta_city == city
+        if area:
+            mask &= self.meta_area == area
+        return mask
+
+    def ensure_meta_table(self):
+        """Load grid_id/city/area into the DuckDB table `meta`, with the same rules as load_metadata."""
+        if self._meta_table:
+            return
+        with self._attach_lock:
+            if self._meta_table:
+                return
+            sql = _metadata_sql(self.meta_path)
+            if sql is None:
+                self.con.execute("CREATE OR REPLACE TABLE meta(grid_id BIGINT, city VARCHAR, area VARCHAR)")
+            else:
+                # read by DuckDB directly: inserting the rows from Python is orders of magnitude slower
+                self.con.execute(f"""
+                    CREATE OR REPLACE TABLE meta AS
+                    SELECT grid_id, city_name AS city, area_name AS area
+                    FROM (SELECT *, row_number() OVER () AS rn FROM ({sql}))
+                    QUALIFY row_number() OVER (PARTITION BY grid_id ORDER BY rn DESC) = 1
+                """, [str(self.meta_path)])
+            self._meta_table = True
+
+    def _colmap(self, y: int) -> Dict[str, str]:
+        if y not in self.year_colmaps:
+            self.year_colmaps[y] = detect_cols(self.year_paths[y])
+        return self.year_colmaps[y]
+
     def _read_csv_sql(self, y: int) -> Tuple[str, Dict[str, str]]:
         p = str(self.year_paths[y])
-        m = self.year_colmaps[y]
+        m = self._colmap(y)
         # Map to canonical names in SQL SELECT
         sel = f"""
             SELECT 
@@ -179,62 +749,65 @@ class DataEngine:
 
     def _build_year(self, y: int, build_edges_o: bool = True, build_edges_d: bool = True, build_hourly: bool = True):
         print(f"[build] year {y} starting ...", flush=True)
+        # dedicated build connection so heavy builds don't evict the serving connection's caches
         con = duckdb.connect(str(self.appdata_dir / f"build_{y}.duckdb"))
         try:
-            con.execute("PRAGMA threads=8;")
+            con.execute(f"PRAGMA threads={DUCKDB_THREADS};")
         except Exception:
             pass
         sel, _ = self._read_csv_sql(y)
+        # parse the CSV exactly once; edges, hourly and totals are all derived from these tables
+        print(f"[build] year {y}: reading csv ...", flush=True)
+        con.execute(f"CREATE OR REPLACE TEMP TABLE src AS {sel}")
+        print(f"[build] year {y}: aggregating edges ...", flush=True)
+        con.execute(
+            """
+            CREATE OR REPLACE TEMP TABLE edges AS
+            SELECT o_grid, d_grid, SUM(num_total) AS num_total
+            FROM src
+            GROUP BY o_grid, d_grid
+            """
+        )
 
         if build_edges_o or build_edges_d:
-            print(f"[build] year {y}: aggregating edges ...", flush=True)
-            con.execute(f"CREATE OR REPLACE TEMP VIEW src AS {sel}")
-            con.execute(
-                """
-                CREATE OR REPLACE TEMP VIEW edges AS
-                SELECT o_grid, d_grid, SUM(num_total) AS num_total
-                FROM src
-                GROUP BY o_grid, d_grid
-                """
-            )
-            if build_edges_o:
-                path_o_p = self._parquet_path("edges_by_o", y)
-                # overwrite any existing file to avoid stale sample indexes
-                try:
-                    path_o_p.unlink(missing_ok=True)
-                except Exception:
-                    pass
-                path_o = str(path_o_p)
-                print(f"[build] year {y}: writing {path_o} ...", flush=True)
-                con.execute(
-                    f"COPY (SELECT * FROM edges ORDER BY o_grid) TO '{path_o}' (FORMAT PARQUET, COMPRESSION ZSTD)"
-                )
-            if build_edges_d:
-                path_d_p = self._parquet_path("edges_by_d", y)
+            for kind, key, flag in (("edges_by_o", "o_grid", build_edges_o), ("edges_by_d", "d_grid", build_edges_d)):
+                if not flag:
+                    continue
+                out_dir = self._edges_dir(kind, y)
+                # overwrite any existing output (and a single-file build from before) to avoid stale sample indexes
                 try:
-                    path_d_p.unlink(missing_ok=True)
+                    self.appdata_dir.joinpath(f"{kind}_{y}.parquet").unlink(missing_ok=True)
+                    shutil.rmtree(out_dir, ignore_errors=True)
                 except Exception:
                     pass
-                path_d = str(path_d_p)
-                print(f"[build] year {y}: writing {path_d} ...", flush=True)
+                print(f"[build] year {y}: writing {out_dir} ...", flush=True)
                 con.execute(
-                    f"COPY (SELECT * FROM edges ORDER BY d_grid) TO '{path_d}' (FORMAT PARQUET, COMPRESSION ZSTD)"
+                    f"""
+                    COPY (SELECT *, {key} % {EDGES_PARTITIONS} AS {key[0]}_mod FROM edges ORDER BY {key})
+                    TO '{out_dir}' (FORMAT PARQUET, COMPRESSION SNAPPY, ROW_GROUP_SIZE 100000,
+                                    PARTITION_BY ({key[0]}_mod), OVERWRITE_OR_IGNORE)
+                    """
                 )
+            self.build_edges_db_for_year(y)
 
         if build_hourly:
             print(f"[build] year {y}: aggregating hourly per grid/week ...", flush=True)
-            con.execute(f"CREATE OR REPLACE TEMP VIEW src AS {sel}")
             con.execute(
                 """
                 CREATE OR REPLACE TEMP VIEW t AS
                 SELECT 
-                  TRY_STRPTIME(CASE WHEN LENGTH(date_dt)=8 THEN date_dt ELSE NULL END, '%Y%m%d')::DATE AS dt,
+                  -- YYYYMMDD as an integer split arithmetically: much cheaper per row than strptime;
+                  -- TRY() still turns impossible dates (e.g. 20210230) into NULL
+                  TRY(MAKE_DATE(d // 10000, d // 100 % 100, d % 100)) AS dt,
                   hour,
                   o_grid,
                   d_grid,
                   num_total
-                FROM src
-                WHERE dt IS NOT NULL
+                FROM (
+                  SELECT CASE WHEN LENGTH(date_dt) = 8 THEN TRY_CAST(date_dt AS INTEGER) END AS d, *
+                  FROM src
+                )
+                WHERE d >= 10000101 AND dt IS NOT NULL
                 """
             )
             con.execute(
@@ -272,7 +845,7 @@ class DataEngine:
                 CREATE OR REPLACE TEMP VIEW hourly AS
                 SELECT 
                   grid_id,
-                  DATE_PART('week', dt)::INTEGER AS week,
+                  WEEK(dt)::INTEGER AS week,
                   hour::INTEGER AS hour,
                   SUM(out_total) AS out_total,
                   SUM(in_total) AS in_total,
@@ -289,34 +862,23 @@ class DataEngine:
             path_h = str(path_h_p)
             print(f"[build] year {y}: writing {path_h} ...", flush=True)
             con.execute(
-                f"COPY (SELECT * FROM hourly ORDER BY grid_id, week, hour) TO '{path_h}' (FORMAT PARQUET, COMPRESSION ZSTD)"
+                f"COPY (SELECT * FROM hourly ORDER BY grid_id, week, hour) TO '{path_h}' (FORMAT PARQUET, COMPRESSION SNAPPY, ROW_GROUP_SIZE 100000)"
             )
         # Always (re)build per-grid totals (in,out,total) for heatmap
-        try:
-            print(f"[build] year {y}: aggregating per-grid totals ...", flush=True)
-            con.execute("CREATE OR REPLACE TEMP VIEW e AS SELECT * FROM edges")
-        except Exception:
-            # edges view may not exist if only hourly requested; create from raw
-            con.execute(f"CREATE OR REPLACE TEMP VIEW src AS {sel}")
-            con.execute(
-                """
-                CREATE OR REPLACE TEMP VIEW e AS
-                SELECT o_grid, d_grid, SUM(num_total) AS num_total
-                FROM src GROUP BY o_grid, d_grid
-                """
-            )
+        # (read-hot files use SNAPPY / no compression: zstd decode cost outweighs the IO saved on local disk)
+        print(f"[build] year {y}: aggregating per-grid totals ...", flush=True)
         con.execute(
             """
             CREATE OR REPLACE TEMP VIEW gout AS
             SELECT o_grid AS grid_id, SUM(num_total) AS out_total
-            FROM e GROUP BY o_grid
+            FROM edges GROUP BY o_grid
             """
         )
         con.execute(
             """
             CREATE OR REPLACE TEMP VIEW gin AS
             SELECT d_grid AS grid_id, SUM(num_total) AS in_total
-            FROM e GROUP BY d_grid
+            FROM edges GROUP BY d_grid
             """
         )
         con.execute(
@@ -335,8 +897,10 @@ class DataEngine:
         except Exception:
             pass
         con.execute(
-            f"COPY (SELECT * FROM gt ORDER BY grid_id) TO '{str(totals_p)}' (FORMAT PARQUET, COMPRESSION ZSTD)"
+            f"COPY (SELECT * FROM gt ORDER BY grid_id) TO '{str(totals_p)}' (FORMAT PARQUET, COMPRESSION UNCOMPRESSED)"
         )
+        con.execute("DROP VIEW IF EXISTS gt; DROP VIEW IF EXISTS gout; DROP VIEW IF EXISTS gin")
+        con.execute("DROP TABLE IF EXISTS edges; DROP TABLE IF EXISTS src")
         con.close()
         try:
             (self.appdata_dir / f"build_{y}.duckdb").unlink(missing_ok=True)
@@ -351,54 +915,10 @@ class DataEngine:
         if cov < 0.0: cov = 0.0
         if cov > 1.0: cov = 1.0
         if direction in ("out", "both"):
-            p = str(self._parquet_path("edges_by_o", year))
-            with duckdb.connect() as con:
-                if cov > 0.0:
-                    sql = f"""
-                        WITH e AS (
-                          SELECT d_grid, num_total FROM read_parquet('{p}') WHERE o_grid = ?
-                        )
-                        SELECT d_grid, num_total
-                        FROM (
-                            SELECT d_grid, num_total,
-                                   SUM(num_total) OVER (ORDER BY num_total DESC ROWS UNBOUNDED PRECEDING) AS cs,
-                                   SUM(num_total) OVER () AS tot
-                            FROM e
-                            ORDER BY num_total DESC
-                        )
-                        WHERE cs <= ? * tot
-                        ORDER BY num_total DESC
-                        LIMIT ?
-                    """
-                    rows = con.execute(sql, [grid_id, cov, topk]).fetchall()
-                else:
-                    sql = f"SELECT d_grid, num_total FROM read_parquet('{p}') WHERE o_grid = ? ORDER BY num_total DESC LIMIT ?"
-                    rows = con.execute(sql, [grid_id, topk]).fetchall()
+            rows = self._flows_rows(year, "edges_by_o", grid_id, topk, cov)
             result["out"] = [{"d_grid": int(d), "num_total": float(v)} for (d, v) in rows]
         if direction in ("in", "both"):
-            p = str(self._parquet_path("edges_by_d", year))
-            with duckdb.connect() as con:
-                if cov > 0.0:
-                    sql = f"""
-                        WITH e AS (
-                          SELECT o_grid, num_total FROM read_parquet('{p}') WHERE d_grid = ?
-                        )
-                        SELECT o_grid, num_total
-                        FROM (
-                            SELECT o_grid, num_total,
-                                   SUM(num_total) OVER (ORDER BY num_total DESC ROWS UNBOUNDED PRECEDING) AS cs,
-                                   SUM(num_total) OVER () AS tot
-                            FROM e
-                            ORDER BY num_total DESC
-                        )
-                        WHERE cs <= ? * tot
-                        ORDER BY num_total DESC
-                        LIMIT ?
-                    """
-                    rows = con.execute(sql, [grid_id, cov, topk]).fetchall()
-                else:
-                    sql = f"SELECT o_grid, num_total FROM read_parquet('{p}') WHERE d_grid = ? ORDER BY num_total DESC LIMIT ?"
-                    rows = con.execute(sql, [grid_id, topk]).fetchall()
+            rows = self._flows_rows(year, "edges_by_d", grid_id, topk, cov)
             result["in"] = [{"o_grid": int(o), "num_total": float(v)} for (o, v) in rows]
 
         # enrich with coords
@@ -422,44 +942,65 @@ class DataEngine:
         return {"center": center, "out_edges": out_edges, "in_edges": in_edges}
 
     def hourly_series_for_grid(self, grid_id: int, years: List[int] = None) -> Dict[int, Dict[str, List[List[float]]]]:
+        return self.hourly_series_for_grids([grid_id], years)[grid_id]
+
+    def hourly_series_for_grids(self, grid_ids: List[int], years: List[int] = None) -> Dict[int, Dict[int, Dict[str, List[List[float]]]]]:
+        """Hourly series for many grids with one query per year; grids without rows get zero series."""
         years = years or YEARS
-        out: Dict[int, Dict[str, List[List[float]]]] = {}
+        ids = sorted({int(g) for g in grid_ids})
+        out: Dict[int, Dict[int, Dict[str, List[List[float]]]]] = {g: {} for g in ids}
+        if not ids:
+            return out
         for y in years:
             pth = self._parquet_path("hourly", y)
             if not pth.exists():
                 continue
             p = str(pth)
-            with duckdb.connect() as con:
-                rows = con.execute(
-                    f"SELECT week, hour, out_total, in_total, total FROM read_parquet('{p}') WHERE grid_id = ? ORDER BY week, hour",
-                    [grid_id],
-                ).fetchall()
-            weeks_all = sorted({int(r[0]) for r in rows})
-            # Only keep earliest week (changed from 3 weeks to 1 week)
-            weeks = weeks_all[:1]
-            week_map = {w: f"W{i+1}" for i, w in enumerate(weeks)}
-            tmp = {"out": {"W1": [0.0]*24},
-                   "in": {"W1": [0.0]*24},
-                   "total": {"W1": [0.0]*24}}
-            for w, h, out_t, in_t, tot in rows:
-                key = week_map.get(int(w))
-                if not key:
-                    continue
+            # Only keep each grid's earliest week (changed from 3 weeks to 1 week)
+            sql = (
+                "SELECT grid_id, hour, out_total, in_total, total FROM read_parquet(?) "
+                "WHERE grid_id IN (SELECT UNNEST(?::BIGINT[])) "
+                "QUALIFY week = MIN(week) OVER (PARTITION BY grid_id) AND hour >= 0 AND hour < 24"
+            )
+            if np is not None:
+                with self.cursor() as con:
+                    cols = con.execute(sql, [p, ids]).fetchnumpy()
+                # scatter rows into a (grid, metric, hour) block, convert to lists only at the end
+                block = np.zeros((len(ids), 3, 24), dtype=np.float64)
+                pos = np.searchsorted(np.asarray(ids, dtype=np.int64), np.asarray(cols["grid_id"], dtype=np.int64))
+                hrs = np.asarray(cols["hour"], dtype=np.int64)
+                for m, name in enumerate(("out_total", "in_total", "total")):
+                    block[pos, m, hrs] = np.asarray(cols[name], dtype=np.float64)
+                for g, (o, i, t) in zip(ids, block.tolist()):
+                    out[g][y] = {"out": [o], "in": [i], "total": [t]}
+                continue
+            with self.cursor() as con:
+                rows = con.execute(sql, [p, ids]).fetchall()
+            for g in ids:
+                out[g][y] = {"out": [[0.0] * 24], "in": [[0.0] * 24], "total": [[0.0] * 24]}
+            for g, h, out_t, in_t, tot in rows:
+                series = out[int(g)][y]
                 h = int(h)
-                if 0 <= h < 24:
-                    tmp["out"][key][h] = float(out_t)
-                    tmp["in"][key][h] = float(in_t)
-                    tmp["total"][key][h] = float(tot)
-            out[y] = {
-                "out": [tmp["out"][f"W{i}"] for i in range(1, 2)],
-                "in": [tmp["in"][f"W{i}"] for i in range(1, 2)],
-                "total": [tmp["total"][f"W{i}"] for i in range(1, 2)],
-            }
+                series["out"][0][h] = float(out_t)
+                series["in"][0][h] = float(in_t)
+                series["total"][0][h] = float(tot)
         return out
 
 
 VERSION = "2025-10-14"
 
+# label-buffer flush of every live app, run once at interpreter exit (not one atexit hook per create_app)
+_LABEL_FLUSHERS = weakref.WeakSet()
+
+
+@atexit.register
+def _flush_all_labels():
+    for flush in list(_LABEL_FLUSHERS):
+        try:
+            flush()
+        except Exception as e:
+            print(f"[labels] flush at exit failed: {e}", file=sys.stderr, flush=True)
+
 
 def create_app(use_sample: bool = False, parquet_only: bool = False) -> Flask:
     _ensure_dirs()
@@ -478,7 +1019,7 @@ def create_app(use_sample: bool = False, parquet_only: bool = False) -> Flask:
             sp = DATA_DIR / f"{y}.sample_sz.csv"
             if sp.exists():
                 engine.year_paths[y] = sp
-                engine.year_colmaps[y] = detect_cols(sp)
+                engine.year_colmaps.pop(y, None)  # re-detected lazily for the sample file
 
     @app.route("/")
     def index():
@@ -498,6 +1039,9 @@ def create_app(use_sample: bool = False, parquet_only: bool = False) -> Flask:
         routes = {
             "label_queue_back": True,
             "label_queue_set": True,
+            "label_advance": True,
+            "label_batch": True,
+            "hourly_bulk": True,
             "heat": True,
             "bounds": True,
         }
@@ -525,6 +1069,9 @@ def create_app(use_sample: bool = False, parquet_only: bool = False) -> Flask:
         if not city and not area:
             # for safety: if no filters, still allow but clients should filter client-side
             return jsonify(engine.meta_items)
+        if engine.meta_idx is not None:
+            meta_items = engine.meta_items
+            return jsonify([meta_items[i] for i in np.flatnonzero(engine.meta_mask(city, area)).tolist()])
         items = []
         for m in engine.meta_items:
             if city and (m.get("city_name") or "") != city:
@@ -556,6 +1103,8 @@ def create_app(use_sample: bool = False, parquet_only: bool = False) -> Flask:
         engine.ensure_built(ys)
         return jsonify({"status": "ok", "built": ys})
 
+    flows_pool = ThreadPoolExecutor(max_workers=len(YEARS), thread_name_prefix="flows")  # year=all fan-out
+
     @app.route("/api/flows")
     def api_flows():
         year_param = request.args.get("year", "2018")
@@ -565,22 +1114,29 @@ def create_app(use_sample: bool = False, parquet_only: bool = False) -> Flask:
         direction = request.args.get("direction", "both")
         topk = int(request.args.get("topk", "100"))
         cov = float(request.args.get("cov", "0"))
+        as_arrow = request.args.get("format") == "arrow"
+        if as_arrow and pa is None:
+            return jsonify({"error": "format=arrow requires pyarrow"}), 501
 
         if year_param == "all":
-            data = {}
-            available = []
-            for y in YEARS:
-                if engine._parquet_path("edges_by_o", y).exists() and engine._parquet_path("edges_by_d", y).exists():
-                    data[y] = engine.flows_for_grid(y, grid_id, direction=direction, topk=topk, cov=cov)
-                    available.append(y)
+            # one lookup per year in parallel; each runs on its own pooled DuckDB cursor
+            available = [y for y in YEARS
+                         if engine._parquet_path("edges_by_o", y).exists() and engine._parquet_path("edges_by_d", y).exists()]
+            futs = {y: flows_pool.submit(engine.flows_for_grid, y, grid_id, direction=direction, topk=topk, cov=cov)
+                    for y in available}
+            data = {y: futs[y].result() for y in available}
             if not available:
                 return jsonify({"error": "no indexes available", "hint": "POST /api/build or run: python vis/server.py --build"}), 404
+            if as_arrow:
+                return _arrow_response(_flows_arrow_columns(data), {"grid_id": grid_id})
             return jsonify({"years": data})
         else:
             y = int(year_param)
             if not engine._parquet_path("edges_by_o", y).exists() or not engine._parquet_path("edges_by_d", y).exists():
                 return jsonify({"error": "index missing", "hint": "POST /api/build or run: python vis/server.py --build", "years": [y]}), 409
             data = engine.flows_for_grid(y, grid_id, direction=direction, topk=topk, cov=cov)
+            if as_arrow:
+                return _arrow_response(_flows_arrow_columns({y: data}), {"grid_id": grid_id})
             return jsonify(data)
 
     @app.route("/api/hourly")
@@ -589,13 +1145,85 @@ def create_app(use_sample: bool = False, parquet_only: bool = False) -> Flask:
         if grid_id == 0:
             return jsonify({"error": "grid_id required"}), 400
         # return available years only to avoid blank chart
-        out = {}
-        for y in YEARS:
-            if engine._parquet_path("hourly", y).exists():
-                out[y] = engine.hourly_series_for_grid(grid_id)[y]
-        if not out:
+        years = [y for y in YEARS if engine._parquet_path("hourly", y).exists()]
+        if not years:
             return jsonify({})
-        return jsonify(out)
+        # one query per available year, not one full all-years lookup per year
+        return jsonify(engine.hourly_series_for_grid(grid_id, years))
+
+    @app.route("/api/hourly_bulk")  # hourly series for many grids: ?ids=1,2,3 -> {grid_id: {year: series}}
+    def api_hourly_bulk():
+        try:
+            ids = [int(x) for x in request.args.get("ids", "").split(",") if x.strip()]
+        except ValueError:
+            return jsonify({"error": "ids must be comma-separated integers"}), 400
+        if not ids:
+            return jsonify({"error": "ids required"}), 400
+        if len(ids) > HOURLY_BULK_MAX:
+            return jsonify({"error": f"at most {HOURLY_BULK_MAX} ids per request"}), 400
+        years = [y for y in YEARS if engine._parquet_path("hourly", y).exists()]
+        if not years:
+            return jsonify({})
+        series = engine.hourly_series_for_grids(ids, years)
+        return jsonify({str(g): v for g, v in series.items()})
+
+    def _heat_build(p: Path, year: int, metric: str, city: str, area: str, as_arrow: bool) -> Response:
+        """/api/heat payload for one filter tuple; callers go through _heat_cached."""
+        if np is not None:
+            # in-memory columns: gather the filtered rows and take p95 with a partial sort
+            t = engine.totals_arrays(year)
+            idx = None
+            empty = np.zeros(0, dtype=np.int64)
+            if city:
+                idx = t["city_idx"].get(city, empty)
+            if area and idx is None:
+                idx = t["area_idx"].get(area, empty)
+            elif area:
+                # narrow the city's rows by area code: one gather + compare instead of intersecting two index sets
+                code = t["area_codes"].get(area)
+                idx = idx[t["area_code"][idx] == code] if code is not None else empty
+            gids = t["grid_id"] if idx is None else t["grid_id"][idx]
+            vals = t[metric] if idx is None else t[metric][idx]
+            n = int(vals.shape[0])
+            if n == 0:
+                if as_arrow:
+                    return _arrow_response({"grid_id": gids, "v": vals}, {"q95": 0, "max": 0, "n": 0})
+                return jsonify({"values": [], "q95": 0, "max": 0, "n": 0})
+            k = int(0.95 * (n - 1))
+            q95 = np.partition(vals, k)[k]
+            if as_arrow:
+                # the NumPy columns go straight into the Arrow buffers, no per-row objects
+                return _arrow_response({"grid_id": gids, "v": vals}, {"q95": float(q95), "max": float(vals.max()), "n": n})
+            items = [{"grid_id": g, "v": v} for g, v in zip(gids.tolist(), vals.tolist())]
+            return _json_response({"values": items, "q95": float(q95), "max": float(vals.max()), "n": n})
+        # no NumPy: filter against the `meta` table and take p95/max in DuckDB
+        engine.ensure_meta_table()
+        col = {"total": "total", "in": "in_total", "out": "out_total"}[metric]
+        with engine.cursor() as con:
+            gids, vs, q95, mx = con.execute(f"""
+                WITH h AS (
+                    SELECT t.grid_id, t.{col}::DOUBLE AS v
+                    FROM read_parquet(?) t JOIN meta m USING (grid_id)
+                    WHERE (? = '' OR m.city = ?) AND (? = '' OR m.area = ?)
+                )
+                SELECT list(grid_id ORDER BY grid_id), list(v ORDER BY grid_id),
+                       list_sort(list(v))[CAST(floor(0.95 * (count(*) - 1)) AS BIGINT) + 1], max(v)
+                FROM h
+            """, [str(p), city, city, area, area]).fetchone()
+        gids, vs = gids or [], vs or []
+        if as_arrow:
+            return _arrow_response({"grid_id": pa.array(gids, type=pa.int64()), "v": pa.array(vs, type=pa.float64())},
+                                   {"q95": float(q95 or 0), "max": float(mx or 0), "n": len(vs)})
+        if not vs:
+            return jsonify({"values": [], "q95": 0, "max": 0, "n": 0})
+        items = [{"grid_id": g, "v": v} for g, v in zip(gids, vs)]
+        return _json_response({"values": items, "q95": float(q95), "max": float(mx), "n": len(items)})
+
+    @functools.lru_cache(maxsize=HEAT_CACHE_SIZE)
+    def _heat_cached(year: int, metric: str, city: str, area: str, as_arrow: bool, mtime: float) -> Tuple[bytes, bytes, str, str]:
+        # mtime is only part of the key, so a rebuilt totals file gets fresh entries
+        resp = _heat_build(engine._parquet_path("totals", year), year, metric, city, area, as_arrow)
+        return _encode_payload(resp)
 
     @app.route("/api/heat")
     def api_heat():
@@ -612,28 +1240,10 @@ def create_app(use_sample: bool = False, parquet_only: bool = False) -> Flask:
                 return jsonify({"error": "cannot build totals", "detail": str(e)}), 500
         city = request.args.get("city_name", "")
         area = request.args.get("area_name", "")
-        # read all then filter in Python; small (<= grid count) and fast
-        with duckdb.connect() as con:
-            rows = con.execute(f"SELECT grid_id, out_total, in_total, total FROM read_parquet('{str(p)}')").fetchall()
-        items = []
-        for gid, out_t, in_t, tot in rows:
-            m = engine.meta_by_id.get(int(gid))
-            if not m:
-                continue
-            if city and m.get("city_name", "") != city:
-                continue
-            if area and m.get("area_name", "") != area:
-                continue
-            val = float(tot if metric == "total" else (in_t if metric == "in" else out_t))
-            items.append({"grid_id": int(gid), "v": val})
-        if not items:
-            return jsonify({"values": [], "q95": 0, "max": 0, "n": 0})
-        # compute p95 and max for scaling
-        vs = sorted([it["v"] for it in items])
-        import math
-        q95 = vs[int(math.floor(0.95 * (len(vs)-1)))] if len(vs) > 1 else vs[0]
-        mx = vs[-1]
-        return jsonify({"values": items, "q95": float(q95), "max": float(mx), "n": len(items)})
+        as_arrow = request.args.get("format") == "arrow"
+        if as_arrow and pa is None:
+            return jsonify({"error": "format=arrow requires pyarrow"}), 501
+        return _encoded_response(*_heat_cached(year, metric, city, area, as_arrow, p.stat().st_mtime))
 
     labels_csv = LABELS_DIR / "labels.csv"
     SHOTS_DIR = LABELS_DIR / "shots"
@@ -641,15 +1251,52 @@ def create_app(use_sample: bool = False, parquet_only: bool = False) -> Flask:
     SHP_CACHE_DIR = APPDATA_DIR / "shp_cache"
     SHP_CACHE_DIR.mkdir(parents=True, exist_ok=True)
     _bounds_cache = {"city": None, "district": None}  # lazy loaded
+    _bounds_encoded = {}  # level -> _encode_payload() of the unfiltered /api/bounds body
     queue_json = APPDATA_DIR / "label_queue.json"
+    queue_idx = APPDATA_DIR / "label_queue.idx"  # current pointer, overrides queue_json["index"]
+
+    # parsed labels.csv, reused while (mtime_ns, size) is unchanged. The file normally only grows by
+    # appends, so a changed file is read from "offset" on when the header is the same and the byte
+    # before offset is still a newline; code that rewrites the file resets "key" to force a full parse.
+    _labels_cache: Dict[str, object] = {"key": None, "rows": [], "ids": set(), "offset": 0, "head": b"", "fields": None, "counts": [0] * 10}
 
     def _read_labels() -> List[Dict]:
-        if not labels_csv.exists():
-            return []
-        out: List[Dict] = []
-        with labels_csv.open("r", newline="") as f:
-            reader = csv.DictReader(f)
-            headers = [h.strip() for h in (reader.fieldnames or [])]
+        """Rows of labels.csv (shared cached list: callers must not modify it)."""
+        return _labels_state()[0]
+
+    def _labels_state() -> Tuple[List[Dict], set, List[int]]:
+        """(rows, labeled grid_ids, counts of labels 0..9) of labels.csv, all from the same cache state."""
+        _flush_labels()
+        # stat, key check, parse and cache update form one step: two readers must not both
+        # parse the same appended tail and stack it onto the cache twice
+        with _label_lock:
+            if not labels_csv.exists():
+                return [], set(), [0] * 10
+            st = labels_csv.stat()
+            key = (st.st_mtime_ns, st.st_size)
+            c = _labels_cache
+            if c["key"] == key:
+                return c["rows"], c["ids"], c["counts"]
+            with labels_csv.open("rb") as f:
+                head = f.readline()
+                offset = c["offset"]
+                tail = c["key"] is not None and head == c["head"] and len(head) <= offset <= st.st_size
+                if tail:
+                    f.seek(offset - 1)
+                    tail = f.read(1) == b"\n"
+                if tail:
+                    data = f.read()
+                    data = data[:data.rfind(b"\n") + 1]  # a half-written last line waits for the next read
+                    reader = csv.DictReader(io.StringIO(data.decode(LABELS_ENCODING), newline=""), fieldnames=c["fields"])
+                    fields = c["fields"]
+                else:
+                    f.seek(0)
+                    data = f.read()
+                    offset = 0
+                    reader = csv.DictReader(io.StringIO(data.decode(LABELS_ENCODING), newline=""))
+                    fields = reader.fieldnames
+            headers = [h.strip() for h in (fields or [])]
+            out: List[Dict] = []
             for r in reader:
                 try:
                     item = {
@@ -663,7 +1310,29 @@ def create_app(use_sample: bool = False, parquet_only: bool = False) -> Flask:
                     out.append(item)
                 except Exception:
                     continue
-        return out
+            counts = _label_counts(out)
+            if tail:
+                ids = c["ids"] | {r["grid_id"] for r in out}
+                counts = [a + b for a, b in zip(c["counts"], counts)]
+                out = c["rows"] + out  # new list: earlier callers keep their snapshot
+            else:
+                ids = {r["grid_id"] for r in out}
+            c.update(key=key, rows=out, ids=ids, offset=offset + len(data), head=head, fields=fields, counts=counts)
+            return out, ids, counts
+
+    def _label_counts(rows: List[Dict]) -> List[int]:
+        # rows per label 0..9 (0=其他); anything out of range is not counted
+        if np is not None:
+            a = np.fromiter((r["label"] for r in rows), dtype=np.int64, count=len(rows))
+            return np.bincount(a[(a >= 0) & (a <= 9)], minlength=10).tolist()
+        counts = [0] * 10
+        for r in rows:
+            if 0 <= r["label"] <= 9:
+                counts[r["label"]] += 1
+        return counts
+
+    def _labeled_ids() -> set:
+        return _labels_state()[1]
 
     def _ensure_labels_header_has_remark():
         if not labels_csv.exists():
@@ -682,20 +1351,88 @@ def create_app(use_sample: bool = False, parquet_only: bool = False) -> Flask:
                 writer.writerow(["grid_id", "lon", "lat", "label", "remark"])
                 for r in rows:
                     writer.writerow([r['grid_id'], r['lon'], r['lat'], r['label'], r.get('remark','')])
+            _labels_cache["key"] = None
 
     def _append_label(grid_id: int, label: int, remark: str = ""):
-        m = engine.meta_by_id.get(grid_id)
-        if not m:
-            raise ValueError("grid_id not in metadata")
-        exists = labels_csv.exists()
-        with labels_csv.open("a", newline="") as f:
-            writer = csv.writer(f)
-            if not exists:
-                writer.writerow(["grid_id", "lon", "lat", "label", "remark"])  # header
+        _append_labels([(grid_id, label, remark)])
+
+    # saved labels are buffered and appended to labels.csv in batches (after LABEL_FLUSH_DELAY, at
+    # LABEL_FLUSH_MAX pending rows, or at exit); everything touching labels.csv flushes first
+    _label_buf: List[List] = []
+    _label_lock = threading.RLock()
+    _label_timer: Dict[str, threading.Timer] = {}
+    _label_unsynced = {"n": 0}  # rows appended since the last fdatasync
+
+    def _flush_labels():
+        with _label_lock:
+            timer = _label_timer.pop("t", None)
+            if timer is not None:
+                timer.cancel()
+            if not _label_buf:
+                return
+            rows = _label_buf[:]
+            del _label_buf[:]
+            try:
+                exists = labels_csv.exists()
+                if exists:
+                    _ensure_labels_header_has_remark()
+                buf = io.StringIO()
+                writer = csv.writer(buf)
+                if not exists:
+                    writer.writerow(["grid_id", "lon", "lat", "label", "remark"])  # header
+                # append rows with remark
+                writer.writerows(rows)
+                # the whole batch goes out in one O_APPEND write instead of through a buffered text file
+                data = memoryview(buf.getvalue().encode(LABELS_ENCODING))
+                fd = os.open(labels_csv, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o666)
+                try:
+                    while data:
+                        data = data[os.write(fd, data):]
+                    _label_unsynced["n"] += len(rows)
+                    if _label_unsynced["n"] >= LABEL_FSYNC_EVERY:
+                        getattr(os, "fdatasync", os.fsync)(fd)
+                        _label_unsynced["n"] = 0
+                finally:
+                    os.close(fd)
+            except Exception:
+                _label_buf[:0] = rows  # keep them for the next flush
+                raise
+
+    _LABEL_FLUSHERS.add(_flush_labels)
+
+    def _flush_labels_later():
+        # Timer thread: log a failed flush instead of dying with a traceback nobody sees, and
+        # retry later so the rows put back in the buffer are not stranded until the next save
+        try:
+            _flush_labels()
+        except Exception:
+            app.logger.exception("writing buffered labels to %s failed; retrying in %ss", labels_csv, LABEL_FLUSH_RETRY)
+            with _label_lock:
+                if _label_buf:
+                    _arm_label_timer(LABEL_FLUSH_RETRY)
+
+    def _arm_label_timer(delay: float):
+        # caller holds _label_lock
+        if "t" not in _label_timer:
+            timer = threading.Timer(delay, _flush_labels_later)
+            timer.daemon = True
+            _label_timer["t"] = timer
+            timer.start()
+
+    def _append_labels(items: List[Tuple[int, int, str]]):
+        # validate every grid_id first so a bad row doesn't leave a partial batch on disk
+        rows = []
+        for grid_id, label, remark in items:
+            m = engine.meta_by_id.get(grid_id)
+            if not m:
+                raise ValueError(f"grid_id not in metadata: {grid_id}")
+            rows.append([grid_id, m["lon"], m["lat"], label, remark or ""])
+        with _label_lock:
+            _label_buf.extend(rows)
+            if len(_label_buf) >= LABEL_FLUSH_MAX:
+                _flush_labels()
             else:
-                _ensure_labels_header_has_remark()
-            # append row with remark
-            writer.writerow([grid_id, m["lon"], m["lat"], label, remark or ""]) 
+                _arm_label_timer(LABEL_FLUSH_DELAY)
 
     # ensure screenshot output directory
     try:
@@ -705,6 +1442,18 @@ def create_app(use_sample: bool = False, parquet_only: bool = False) -> Flask:
 
     @app.route("/api/screenshot", methods=["POST"])  # save base64 JPEG to labels/shots
     def api_save_screenshot():
+        # multipart/form-data (fields: filename, image): werkzeug spools the upload, no base64 at all
+        upload = request.files.get("image")
+        if upload is not None:
+            safe = _screenshot_name(request.form.get("filename") or upload.filename or "")
+            if not safe:
+                return jsonify({"error": "filename and image required"}), 400
+            out_path = SHOTS_DIR / safe
+            try:
+                upload.save(str(out_path))
+            except Exception as e:
+                return jsonify({"error": "write failed", "detail": str(e)}), 500
+            return jsonify({"ok": True, "path": str(out_path)})
         try:
             data = request.get_json(force=True)
         except Exception:
@@ -714,60 +1463,120 @@ def create_app(use_sample: bool = False, parquet_only: bool = False) -> Flask:
         b64 = str(data.get("data", "")).strip()
         if not name or not b64:
             return jsonify({"error": "filename and data required"}), 400
-        # normalize filename: only allow [A-Za-z0-9-_ .]
-        safe = ''.join(ch for ch in name if ch.isalnum() or ch in ('-', '_', ' ', '.'))
+        safe = _screenshot_name(name)
         if not safe:
             return jsonify({"error": "bad filename"}), 400
-        # force .jpg extension
-        if not safe.lower().endswith('.jpg') and not safe.lower().endswith('.jpeg'):
-            safe += '.jpg'
         # strip data url prefix if present
         if ',' in b64:
             b64 = b64.split(',', 1)[1]
         import base64
-        try:
-            raw = base64.b64decode(b64, validate=False)
-        except Exception as e:
-            return jsonify({"error": "decode failed", "detail": str(e)}), 400
+        import binascii
         out_path = SHOTS_DIR / safe
         try:
             with out_path.open('wb') as f:
-                f.write(raw)
+                try:
+                    # decode in 64 KB slices (a multiple of 4 chars) so the whole image never exists as one bytes
+                    for i in range(0, len(b64), SHOT_DECODE_CHUNK):
+                        f.write(base64.b64decode(b64[i:i + SHOT_DECODE_CHUNK], validate=True))
+                except binascii.Error:
+                    # whitespace or other stray characters break the slice alignment: decode leniently in one go
+                    f.seek(0)
+                    f.truncate()
+                    f.write(base64.b64decode(b64, validate=False))
+        except binascii.Error as e:
+            out_path.unlink(missing_ok=True)
+            return jsonify({"error": "decode failed", "detail": str(e)}), 400
         except Exception as e:
             return jsonify({"error": "write failed", "detail": str(e)}), 500
         return jsonify({"ok": True, "path": str(out_path)})
 
+    def _screenshot_name(name: str) -> str:
+        # normalize filename: only allow [A-Za-z0-9-_ .]
+        safe = ''.join(ch for ch in name.strip() if ch.isalnum() or ch in ('-', '_', ' ', '.'))
+        if not safe:
+            return ""
+        # force .jpg extension
+        if not safe.lower().endswith('.jpg') and not safe.lower().endswith('.jpeg'):
+            safe += '.jpg'
+        return safe
+
     def _unlabeled_grid_ids(filters: Dict = None) -> List[int]:
-        labeled = {r["grid_id"] for r in _read_labels()}
-        pool = []
+        labeled = _labeled_ids()
         city = (filters or {}).get("city_name") or ""
         area = (filters or {}).get("area_name") or ""
         keyword = (filters or {}).get("keyword") or ""
         kw = keyword.strip().lower()
-        for m in engine.meta_items:
-            if m["grid_id"] in labeled:
-                continue
-            if city and m.get("city_name", "") != city:
-                continue
-            if area and m.get("area_name", "") != area:
-                continue
+        if engine.meta_idx is not None:
+            # column filters over the metadata arrays; keeps meta_items order
+            mask = engine.meta_mask(city, area)
             if kw:
-                text = f"{m.get('city_name','')} {m.get('area_name','')}".lower()
-                if kw not in text:
-                    continue
-            pool.append(m["grid_id"])
-        return pool
+                mask &= np.char.find(engine.meta_text, kw) >= 0
+            if labeled:
+                mask &= ~np.isin(engine.meta_gids, np.fromiter(labeled, dtype=np.int64, count=len(labeled)))
+            return engine.meta_gids[mask].tolist()
+        # load_metadata always sets city_name/area_name, so index them directly
+        return [m["grid_id"] for m, text in zip(engine.meta_items, engine.meta_search)
+                if m["grid_id"] not in labeled
+                and (not city or m["city_name"] == city)
+                and (not area or m["area_name"] == area)
+                and (not kw or kw in text)]
 
     def _read_queue() -> Dict:
         if queue_json.exists():
             try:
-                return json.loads(queue_json.read_text())
+                q = _json_load(queue_json)
             except Exception:
-                pass
+                q = None
+            if q is not None:
+                try:
+                    raw = queue_idx.read_bytes()
+                    if len(raw) == 8:
+                        q["index"] = int.from_bytes(raw, "little")
+                except OSError:
+                    pass
+                return q
         return {"queue": [], "index": 0, "filters": {}, "seed": None}
 
     def _write_queue(data: Dict):
-        queue_json.write_text(json.dumps(data, ensure_ascii=False))
+        # full checkpoint, only when the queue itself changes; drop the pointer file first so a
+        # stale index can never be laid over a new queue
+        queue_idx.unlink(missing_ok=True)
+        _atomic_write_bytes(queue_json, _json_dumps(data))
+
+    def _write_queue_index(idx: int):
+        # moving the pointer rewrites 8 bytes instead of the whole queue JSON; pwrite in place,
+        # never truncating, so a crash can't leave an empty sidecar (and a pointer back at 0)
+        data = int(idx).to_bytes(8, "little")
+        if not hasattr(os, "pwrite"):
+            _atomic_write_bytes(queue_idx, data)
+            return
+        fd = os.open(queue_idx, os.O_RDWR | os.O_CREAT, 0o666)
+        try:
+            os.pwrite(fd, data, 0)
+        finally:
+            os.close(fd)
+
+    def _advance_queue() -> Dict:
+        q = _read_queue()
+        idx = int(q.get("index", 0))
+        queue = q.get("queue", [])
+        if idx < len(queue):
+            idx += 1
+        q["index"] = idx
+        _write_queue_index(idx)
+        has_more = idx < len(queue)
+        cur = queue[idx] if has_more else None
+        return {"index": idx, "has_more": has_more, "current": cur, "total": len(queue)}
+
+    def _set_queue_index(idx: int) -> Dict:
+        q = _read_queue()
+        queue = q.get("queue", [])
+        idx = max(0, min(idx, len(queue)))
+        q["index"] = idx
+        _write_queue_index(idx)
+        has_more = idx < len(queue)
+        cur = queue[idx] if has_more else None
+        return {"index": idx, "has_more": has_more, "current": cur, "total": len(queue)}
 
     @app.route("/api/labels", methods=["GET"])  # list labels
     def api_labels_list():
@@ -775,29 +1584,121 @@ def create_app(use_sample: bool = False, parquet_only: bool = False) -> Flask:
 
     @app.route("/api/labels/stats", methods=["GET"])  # labeled counts per class
     def api_labels_stats():
-        rows = _read_labels()
-        # count labels 0..9 (0=其他)
-        counts = {i: 0 for i in range(0, 10)}
-        for r in rows:
-            try:
-                l = int(r.get("label", -1))
-            except Exception:
-                l = -1
-            if 0 <= l <= 9:
-                counts[l] = counts.get(l, 0) + 1
-        total = sum(counts.values())
+        # count labels 0..9 (0=其他), kept up to date with the labels cache
+        counts = _labels_state()[2]
+        total = sum(counts)
         # return as by_label with string keys for stability
-        by_label = {str(k): int(v) for k, v in counts.items()}
+        by_label = {str(k): int(v) for k, v in enumerate(counts)}
         return jsonify({"total": int(total), "by_label": by_label})
 
     @app.route("/api/labels/download", methods=["GET"])  # download labels.csv
     def api_labels_download():
-        if not labels_csv.exists():
-            # create empty
-            with labels_csv.open("w", newline="") as f:
-                writer = csv.writer(f)
-                writer.writerow(["grid_id", "lon", "lat", "label"])
-        return send_file(str(labels_csv), as_attachment=True)
+        _flush_labels()
+        # seeded at startup; undo of the last row removes the file, so it may still be missing
+        _seed_labels_csv(labels_csv)
+        # conditional GET: unchanged labels.csv answers If-None-Match / If-Modified-Since with 304
+        return send_file(str(labels_csv), as_attachment=True, conditional=True, etag=True,
+                         last_modified=labels_csv.stat().st_mtime)
+
+    def _read_import_rows(path: Path) -> List[Dict]:
+        # fast path: typed columnar parse with pyarrow; any malformed cell raises and we
+        # fall back to the lenient per-row loop below, which skips bad rows
+        if pacsv is not None:
+            try:
+                table = pacsv.read_csv(
+                    str(path),
+                    read_options=pacsv.ReadOptions(encoding=LABELS_ENCODING),
+                    convert_options=pacsv.ConvertOptions(
+                        column_types={"grid_id": pa.int64(), "lon": pa.float64(), "lat": pa.float64(), "label": pa.int64()},
+                        null_values=[""],
+                        strings_can_be_null=True,
+                    ),
+                )
+                names = set(table.column_names)
+                if {"grid_id", "label"} <= names:
+                    n = table.num_rows
+                    cols = {c: table.column(c).to_pylist() if c in names else [0.0] * n for c in ("grid_id", "lon", "lat", "label")}
+                    return [
+                        {"grid_id": g, "lon": lon or 0.0, "lat": lat or 0.0, "label": lab}
+                        for g, lon, lat, lab in zip(cols["grid_id"], cols["lon"], cols["lat"], cols["label"])
+                        if g is not None and lab is not None
+                    ]
+            except Exception:
+                pass
+        import_rows: List[Dict] = []
+        with path.open('r', newline='') as f:
+            reader = csv.DictReader(f)
+            for r in reader:
+                try:
+                    import_rows.append({
+                        "grid_id": int(r["grid_id"]),
+                        "lon": float(r.get("lon", 0) or 0),
+                        "lat": float(r.get("lat", 0) or 0),
+                        "label": int(r["label"]),
+                    })
+                except Exception:
+                    continue
+        return import_rows
+
+    def _upsert_labels_duckdb(import_rows: List[Dict]) -> bool:
+        # Same result as the dict upsert in api_labels_import (first position of each grid_id, last
+        # value wins, imported rows win, new ids appended in import order), but the existing
+        # labels.csv is read, merged and written by DuckDB instead of row by row in Python.
+        # Returns False when it cannot run, so the caller falls back to the Python path.
+        if pa is None or not labels_csv.exists():
+            return False
+        gids, lons, lats, labs = [], [], [], []
+        for r in import_rows:
+            # enrich coords from metadata if missing
+            m = engine.meta_by_id.get(r["grid_id"]) or {"lon": r.get("lon", 0.0), "lat": r.get("lat", 0.0)}
+            gids.append(r["grid_id"]); lons.append(float(m["lon"])); lats.append(float(m["lat"])); labs.append(r["label"])
+        incoming = pa.table({
+            "rn": pa.array(range(len(gids)), type=pa.int64()),
+            "grid_id": pa.array(gids, type=pa.int64()),
+            "lon": pa.array(lons, type=pa.float64()),
+            "lat": pa.array(lats, type=pa.float64()),
+            "label": pa.array(labs, type=pa.int64()),
+        })
+        # unique temp file next to labels.csv: concurrent imports must not share one
+        fd, tmp = tempfile.mkstemp(dir=str(labels_csv.parent), prefix=labels_csv.name + ".", suffix=".tmp")
+        os.close(fd)
+        tmp = Path(tmp)
+        escaped = str(tmp).replace("'", "''")
+        con = engine.cursor()
+        try:
+            con.register("incoming", incoming)
+            con.execute(f"""
+                COPY (
+                  WITH raw AS (
+                    SELECT row_number() OVER () AS rn,
+                           TRY_CAST(grid_id AS BIGINT) AS grid_id, TRY_CAST(lon AS DOUBLE) AS lon,
+                           TRY_CAST(lat AS DOUBLE) AS lat, TRY_CAST(label AS BIGINT) AS label
+                    FROM read_csv(?, all_varchar=true, header=true, delim=',', quote='"', escape='"')
+                  ), ex AS (
+                    SELECT grid_id, MIN(rn) AS pos, ARG_MAX(lon, rn) AS lon, ARG_MAX(lat, rn) AS lat, ARG_MAX(label, rn) AS label
+                    FROM raw
+                    WHERE grid_id IS NOT NULL AND lon IS NOT NULL AND lat IS NOT NULL AND label IS NOT NULL
+                    GROUP BY grid_id
+                  ), inc AS (
+                    SELECT grid_id, MIN(rn) AS pos, ARG_MAX(lon, rn) AS lon, ARG_MAX(lat, rn) AS lat, ARG_MAX(label, rn) AS label
+                    FROM incoming
+                    GROUP BY grid_id
+                  )
+                  SELECT grid_id,
+                         CASE WHEN i.grid_id IS NULL THEN e.lon ELSE i.lon END AS lon,
+                         CASE WHEN i.grid_id IS NULL THEN e.lat ELSE i.lat END AS lat,
+                         CASE WHEN i.grid_id IS NULL THEN e.label ELSE i.label END AS label
+                  FROM ex e FULL JOIN inc i USING (grid_id)
+                  ORDER BY e.pos NULLS LAST, i.pos
+                ) TO '{escaped}' (HEADER, FORMAT CSV, NEW_LINE '\r\n')
+            """, [str(labels_csv)])
+            os.replace(tmp, labels_csv)
+            return True
+        except Exception:
+            tmp.unlink(missing_ok=True)
+            return False
+        finally:
+            con.close()
 
     @app.route("/api/labels/import", methods=["POST"])  # import labels CSV
     def api_labels_import():
@@ -811,20 +1712,9 @@ def create_app(use_sample: bool = False, parquet_only: bool = False) -> Flask:
         tmp_path = APPDATA_DIR / ("import_" + secure_filename(file.filename))
         file.save(str(tmp_path))
         # Read incoming
-        import_rows: List[Dict] = []
-        with tmp_path.open('r', newline='') as f:
-            reader = csv.DictReader(f)
-            for r in reader:
-                try:
-                    import_rows.append({
-                        "grid_id": int(r["grid_id"]),
-                        "lon": float(r.get("lon", 0) or 0),
-                        "lat": float(r.get("lat", 0) or 0),
-                        "label": int(r["label"]),
-                    })
-                except Exception:
-                    continue
+        import_rows = _read_import_rows(tmp_path)
         tmp_path.unlink(missing_ok=True)
+        _flush_labels()
         if mode == 'append':
             exists = labels_csv.exists()
             with labels_csv.open('a', newline='') as f:
@@ -834,7 +1724,7 @@ def create_app(use_sample: bool = False, parquet_only: bool = False) -> Flask:
                 for r in import_rows:
                     m = engine.meta_by_id.get(r["grid_id"]) or {"lon": r["lon"], "lat": r["lat"]}
                     writer.writerow([r["grid_id"], m["lon"], m["lat"], r["label"]])
-        else:  # upsert by grid_id
+        elif not _upsert_labels_duckdb(import_rows):  # upsert by grid_id
             # Build map from existing + imported (imported wins)
             latest: Dict[int, Dict] = {r["grid_id"]: r for r in _read_labels()}
             for r in import_rows:
@@ -846,6 +1736,7 @@ def create_app(use_sample: bool = False, parquet_only: bool = False) -> Flask:
                 writer.writerow(["grid_id", "lon", "lat", "label"])  # header
                 for gid, r in latest.items():
                     writer.writerow([gid, r["lon"], r["lat"], r["label"]])
+        _labels_cache["key"] = None
         return jsonify({"ok": True, "mode": mode, "imported": len(import_rows)})
 
     @app.route("/api/label", methods=["POST"])  # save one label
@@ -858,20 +1749,55 @@ def create_app(use_sample: bool = False, parquet_only: bool = False) -> Flask:
         if label < 0 or label > 9:
             return jsonify({"error": "label must be 0..9, where 0=其他"}), 400
         _append_label(grid_id, label, remark)
+        # optional: advance the persistent queue in the same request (saves a round-trip for batch clients)
+        if data.get("advance"):
+            return jsonify({"ok": True, "advance": _advance_queue()})
         return jsonify({"ok": True})
 
+    @app.route("/api/label_batch", methods=["POST"])  # save many labels at once, optionally move queue pointer
+    def api_label_batch():
+        data = request.get_json(force=True, silent=True) or {}
+        items = []
+        try:
+            for it in data.get("labels") or []:
+                label = int(it.get("label"))
+                if label < 0 or label > 9:
+                    return jsonify({"error": "label must be 0..9, where 0=其他"}), 400
+                items.append((int(it.get("grid_id")), label, str(it.get("remark", "") or "")))
+        except Exception:
+            return jsonify({"error": "labels must be a list of {grid_id, label}"}), 400
+        # advance_to: absolute queue index to move to after saving (covers skipped grids too);
+        # validated before anything is saved so a 400 never leaves half the request applied
+        advance_to = data.get("advance_to")
+        if advance_to is not None:
+            try:
+                advance_to = int(advance_to)
+            except Exception:
+                return jsonify({"error": "advance_to must be an integer"}), 400
+        try:
+            _append_labels(items)
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+        out = {"ok": True, "saved": len(items)}
+        if advance_to is not None:
+            out["advance"] = _set_queue_index(advance_to)
+        return jsonify(out)
+
     @app.route("/api/label/undo", methods=["POST"])  # remove last label row
     def api_label_undo():
+        _flush_labels()
         if not labels_csv.exists():
             return jsonify({"ok": True, "message": "no labels"})
         with labels_csv.open("r", newline="") as f:
             lines = f.readlines()
         if len(lines) <= 1:
             labels_csv.unlink(missing_ok=True)
+            _labels_cache["key"] = None
             return jsonify({"ok": True, "message": "cleared"})
         # keep header and all but last row
         with labels_csv.open("w", newline="") as f:
             f.writelines(lines[:-1])
+        _labels_cache["key"] = None
         return jsonify({"ok": True})
 
     @app.route("/api/label_queue", methods=["GET"])  # read current queue
@@ -930,81 +1856,14 @@ def create_app(use_sample: bool = False, parquet_only: bool = False) -> Flask:
                     break
             if chosen_year is not None:
                 try:
-                    p = str(engine._parquet_path("hourly", chosen_year))
-                    with duckdb.connect() as con:
-                        # Ensure pool grid_ids are considered even if they never appear in hourly parquet
-                        use_pool = True
-                        try:
-                            con.execute("DROP TABLE IF EXISTS pool")
-                            con.execute("CREATE TEMPORARY TABLE pool(gid BIGINT)")
-                            con.executemany("INSERT INTO pool (gid) VALUES (?)", [(int(g),) for g in pool])
-                        except Exception:
-                            use_pool = False
-                        # Use all available weeks for the chosen year (no LIMIT) so the filter reflects the full year data
-                        weeks = [r[0] for r in con.execute(f"SELECT DISTINCT week FROM read_parquet('{p}') ORDER BY week").fetchall()]
-                        debug_info["applied"] = True
-                        debug_info["chosen_year"] = chosen_year
-                        debug_info["weeks"] = [int(w) for w in weeks]
-                        bad_set = set()
-                        if weeks:
-                            week_list = ",".join(str(int(w)) for w in weeks)
-                            if use_pool:
-                                sql = f"""
-                                    WITH base_raw AS (
-                                      SELECT grid_id, hour, total
-                                      FROM read_parquet('{p}')
-                                      WHERE week IN ({week_list})
-                                    ), base AS (
-                                      SELECT br.grid_id, br.hour, AVG(br.total) AS avg_total
-                                      FROM base_raw br JOIN pool p ON br.grid_id = p.gid
-                                      GROUP BY br.grid_id, br.hour
-                                    ), gids AS (
-                                      SELECT gid AS grid_id FROM pool
-                                    ), hrs AS (
-                                      SELECT range AS hour FROM range(0,24)
-                                    ), full24 AS (
-                                      SELECT g.grid_id, h.hour FROM gids g CROSS JOIN hrs h
-                                    ), h AS (
-                                      SELECT f.grid_id, f.hour, COALESCE(b.avg_total, 0) AS avg_total
-                                      FROM full24 f LEFT JOIN base b USING (grid_id, hour)
-                                    ), zr AS (
-                                      SELECT grid_id,
-                                        SUM(CASE WHEN avg_total <= ? THEN 1 ELSE 0 END)::DOUBLE / 24.0 AS low_ratio
-                                      FROM h
-                                      GROUP BY grid_id
-                                    )
-                                    SELECT grid_id FROM zr WHERE low_ratio >= ?
-                                """
-                                rows = con.execute(sql, [float(low_value), float(low_pct)/100.0]).fetchall()
-                            else:
-                                # Fallback: derive gids from parquet (older DuckDB without temp table)
-                                sql = f"""
-                                    WITH base AS (
-                                      SELECT grid_id, hour, AVG(total) AS avg_total
-                                      FROM read_parquet('{p}')
-                                      WHERE week IN ({week_list})
-                                      GROUP BY grid_id, hour
-                                    ), gids AS (
-                                      SELECT DISTINCT grid_id FROM base
-                                    ), hrs AS (
-                                      SELECT range AS hour FROM range(0,24)
-                                    ), full24 AS (
-                                      SELECT g.grid_id, h.hour FROM gids g CROSS JOIN hrs h
-                                    ), h AS (
-                                      SELECT f.grid_id, f.hour, COALESCE(b.avg_total, 0) AS avg_total
-                                      FROM full24 f LEFT JOIN base b USING (grid_id, hour)
-                                    ), zr AS (
-                                      SELECT grid_id,
-                                        SUM(CASE WHEN avg_total <= ? THEN 1 ELSE 0 END)::DOUBLE / 24.0 AS low_ratio
-                                      FROM h
-                                      GROUP BY grid_id
-                                    )
-                                    SELECT grid_id FROM zr WHERE low_ratio >= ?
-                                """
-                            rows = con.execute(sql, [float(low_value), float(low_pct)/100.0]).fetchall()
-                            bad_set = {int(r[0]) for r in rows}
-                        # If no weeks available, keep pool unchanged
-                    pool = [gid for gid in pool if gid not in bad_set]
+                    weeks = engine.hourly_weeks(chosen_year)
+                    debug_info["applied"] = True
+                    debug_info["chosen_year"] = chosen_year
+                    debug_info["weeks"] = list(weeks)
+                    # Use all available weeks for the chosen year so the filter reflects the full year data
+                    if weeks:
+                        pool = engine.low_traffic_keep(chosen_year, pool, float(low_value), float(low_pct)/100.0)
+                    # If no weeks available, keep pool unchanged
                     debug_info["pool_after"] = len(pool)
                     debug_info["removed"] = int(debug_info["pool_before"]) - int(debug_info["pool_after"])
                 except Exception:
@@ -1029,16 +1888,7 @@ def create_app(use_sample: bool = False, parquet_only: bool = False) -> Flask:
 
     @app.route("/api/label_queue/advance", methods=["POST"])  # move pointer forward
     def api_label_queue_advance():
-        q = _read_queue()
-        idx = int(q.get("index", 0))
-        queue = q.get("queue", [])
-        if idx < len(queue):
-            idx += 1
-        q["index"] = idx
-        _write_queue(q)
-        has_more = idx < len(queue)
-        cur = queue[idx] if has_more else None
-        return jsonify({"index": idx, "has_more": has_more, "current": cur, "total": len(queue)})
+        return jsonify(_advance_queue())
 
 
     @app.route("/api/low_filter_debug")
@@ -1080,41 +1930,15 @@ def create_app(use_sample: bool = False, parquet_only: bool = False) -> Flask:
                 break
         if chosen_year is None:
             return jsonify({"error": "no hourly parquet available"}), 404
-        p = str(engine._parquet_path("hourly", chosen_year))
-        # compute over all weeks
+        # compute over all weeks, from the materialised 24h means
         try:
-            with duckdb.connect() as con:
-                weeks = [r[0] for r in con.execute(f"SELECT DISTINCT week FROM read_parquet('{p}') ORDER BY week").fetchall()]
-                if not weeks:
-                    return jsonify({"error": "no weeks in parquet", "year": chosen_year}), 404
-                week_list = ",".join(str(int(w)) for w in weeks)
-                sql = f"""
-                    WITH base_raw AS (
-                      SELECT grid_id, hour, total
-                      FROM read_parquet('{p}')
-                      WHERE week IN ({week_list}) AND grid_id = {grid_id}
-                    ), base AS (
-                      SELECT hour, AVG(total) AS avg_total
-                      FROM base_raw
-                      GROUP BY hour
-                    ), hrs AS (
-                      SELECT range AS hour FROM range(0,24)
-                    ), h AS (
-                      SELECT h.hour, COALESCE(b.avg_total, 0) AS avg_total
-                      FROM hrs h LEFT JOIN base b USING (hour)
-                    )
-                    SELECT hour, avg_total, (avg_total <= ?) AS le
-                    FROM h ORDER BY hour
-                """
-                rows = con.execute(sql, [float(low_value)]).fetchall()
+            if not engine.hourly_weeks(chosen_year):
+                return jsonify({"error": "no weeks in parquet", "year": chosen_year}), 404
+            avg24 = engine.hourly_avg_row(chosen_year, grid_id)
         except Exception as e:
             return jsonify({"error": str(e)}), 500
-        hours = []
-        le_cnt = 0
-        for hour, avg_total, le in rows:
-            hours.append({"hour": int(hour), "avg_total": float(avg_total), "le": bool(le)})
-            if le:
-                le_cnt += 1
+        hours = [{"hour": h, "avg_total": float(v), "le": v <= low_value} for h, v in enumerate(avg24)]
+        le_cnt = sum(1 for h in hours if h["le"])
         ratio = le_cnt / 24.0 if hours else 0.0
         decision = (ratio >= (low_pct/100.0)) if low_pct > 0.0 else False
         return jsonify({
@@ -1136,7 +1960,7 @@ def create_app(use_sample: bool = False, parquet_only: bool = False) -> Flask:
         if idx > 0:
             idx -= 1
         q["index"] = idx
-        _write_queue(q)
+        _write_queue_index(idx)
         has_more = idx < len(queue)
         cur = queue[idx] if idx < len(queue) else None
         return jsonify({"index": idx, "has_more": has_more, "current": cur, "total": len(queue)})
@@ -1163,12 +1987,13 @@ def create_app(use_sample: bool = False, parquet_only: bool = False) -> Flask:
         if idx > len(queue):
             idx = len(queue)
         q["index"] = idx
-        _write_queue(q)
+        _write_queue_index(idx)
         cur = queue[idx] if idx < len(queue) else None
         return jsonify({"index": idx, "current": cur, "total": len(queue)})
 
     @app.route("/api/labels/clear", methods=["POST"])  # clear labels.csv (backup old)
     def api_labels_clear():
+        _flush_labels()
         if labels_csv.exists():
             ts = int(time.time())
             backup = labels_csv.parent / f"labels_backup_{ts}.csv"
@@ -1180,11 +2005,13 @@ def create_app(use_sample: bool = False, parquet_only: bool = False) -> Flask:
         with labels_csv.open("w", newline="") as f:
             writer = csv.writer(f)
             writer.writerow(["grid_id", "lon", "lat", "label", "remark"])  # header
+        _labels_cache["key"] = None
         return jsonify({"ok": True})
 
     @app.route("/api/label_queue/reset", methods=["POST"])  # clear queue
     def api_label_queue_reset():
         queue_json.unlink(missing_ok=True)
+        queue_idx.unlink(missing_ok=True)
         return jsonify({"ok": True})
 
     def _rdp(points, epsilon):
@@ -1212,7 +2039,48 @@ def create_app(use_sample: bool = False, parquet_only: bool = False) -> Flask:
                 return res1[:-1] + res2
             else:
                 return [pts[0], pts[-1]]
-        return rdp_rec(points)
+        if np is None or len(points) < RDP_NUMPY_MIN:
+            return rdp_rec(points)
+        # iterative, vectorised variant: one distance kernel per (lo, hi) span, explicit stack
+        xy = np.asarray(points, dtype=np.float64)
+        keep = np.zeros(len(xy), dtype=bool)
+        keep[0] = keep[-1] = True
+        stack = [(0, len(xy) - 1)]
+        while stack:
+            lo, hi = stack.pop()
+            if hi - lo < 2:
+                continue
+            x1, y1 = xy[lo]; x2, y2 = xy[hi]
+            x = xy[lo+1:hi, 0]; y = xy[lo+1:hi, 1]
+            if x1 == x2 and y1 == y2:
+                d = np.hypot(x - x1, y - y1)
+            else:
+                t = ((x - x1)*(x2 - x1) + (y - y1)*(y2 - y1)) / ((x2 - x1)**2 + (y2 - y1)**2)
+                t = np.clip(t, 0, 1)
+                d = np.hypot(x - (x1 + t*(x2 - x1)), y - (y1 + t*(y2 - y1)))
+            i = int(d.argmax())
+            if d[i] > epsilon:
+                idx = lo + 1 + i
+                keep[idx] = True
+                stack.append((lo, idx)); stack.append((idx, hi))
+        return [points[i] for i in np.flatnonzero(keep)]
+
+    def _geos_simplify(LinearRing, ring, tol, max_pts):
+        # Douglas-Peucker in GEOS (shapely) on a closed ring; the tolerance doubles until the ring
+        # fits max_pts. None when GEOS can't keep a valid ring, so the caller uses _rdp instead
+        if len(ring) < 4 or ring[0] != ring[-1]:
+            return None
+        try:
+            geom = LinearRing(ring)
+            while True:
+                out = geom.simplify(tol, preserve_topology=False)
+                if out.is_empty or len(out.coords) < 4:
+                    return None
+                if len(out.coords) <= max_pts:
+                    return [[float(c[0]), float(c[1])] for c in out.coords]
+                tol *= 2
+        except Exception:
+            return None
 
     def _load_bounds(level: str):
         # level: 'city' -> PRD_CITY, 'district' -> PRD_district
@@ -1238,6 +2106,10 @@ def create_app(use_sample: bool = False, parquet_only: bool = False) -> Flask:
                     transformer = Transformer.from_crs(src, CRS.from_epsg(4326), always_xy=True)
         except Exception:
             transformer = None
+        try:
+            from shapely.geometry import LinearRing  # optional: simplification in C
+        except Exception:
+            LinearRing = None
 
         r = shapefile.Reader(str(shp_path))
         fields = [f[0] for f in r.fields[1:]]
@@ -1267,18 +2139,22 @@ def create_app(use_sample: bool = False, parquet_only: bool = False) -> Flask:
                 # transform
                 ring = []
                 if transformer:
-                    for (x,y) in seg:
-                        lon, lat = transformer.transform(x, y)
-                        ring.append([float(lon), float(lat)])
+                    # one batched PROJ call per ring instead of one per point
+                    lons, lats = transformer.transform([x for (x, _) in seg], [y for (_, y) in seg])
+                    ring = [[float(lon), float(lat)] for lon, lat in zip(lons, lats)]
                 else:
                     for (x,y) in seg:
                         ring.append([float(x), float(y)])
-                # simplify and decimate
-                if len(ring) > 2:
-                    ring = _rdp(ring, tol)
-                if len(ring) > max_pts:
-                    step = max(1, len(ring)//max_pts)
-                    ring = ring[::step]
+                simplified = _geos_simplify(LinearRing, ring, tol, max_pts) if LinearRing is not None else None
+                if simplified is not None:
+                    ring = simplified
+                else:
+                    # simplify and decimate
+                    if len(ring) > 2:
+                        ring = _rdp(ring, tol)
+                    if len(ring) > max_pts:
+                        step = max(1, len(ring)//max_pts)
+                        ring = ring[::step]
                 rings.append(ring)
             out.append({"name": name, "rings": rings})
         return out
@@ -1292,7 +2168,7 @@ def create_app(use_sample: bool = False, parquet_only: bool = False) -> Flask:
             # try load cache
             if cache_file.exists():
                 try:
-                    _bounds_cache[cache_key] = json.loads(cache_file.read_text())
+                    _bounds_cache[cache_key] = _json_load(cache_file)
                 except Exception:
                     _bounds_cache[cache_key] = None
             if _bounds_cache.get(cache_key) is None:
@@ -1302,7 +2178,7 @@ def create_app(use_sample: bool = False, parquet_only: bool = False) -> Flask:
                     return jsonify({"error":"load shapefile failed", "detail": str(e)}), 500
                 # Save cache
                 try:
-                    cache_file.write_text(json.dumps(data, ensure_ascii=False))
+                    _atomic_write_bytes(cache_file, _json_dumps(data))
                 except Exception:
                     pass
                 _bounds_cache[cache_key] = data
@@ -1311,8 +2187,20 @@ def create_app(use_sample: bool = False, parquet_only: bool = False) -> Flask:
         names = request.args.get('names','').strip()
         if names:
             name_set = set([n.strip() for n in names.split(',') if n.strip()])
-            data = [d for d in data if d.get('name') in name_set]
-        return jsonify({"level": cache_key, "items": data})
+            # stream item by item: a filtered layer is encoded per request, so never hold it as one string
+            def gen():
+                yield b'{"level":' + _json_dumps(cache_key) + b',"items":['
+                first = True
+                for d in data:
+                    if d.get('name') in name_set:
+                        yield (b'' if first else b',') + _json_dumps(d)
+                        first = False
+                yield b']}'
+            return Response(gen(), mimetype='application/json')
+        # the full layer never changes while the process runs: encode and gzip it once
+        if cache_key not in _bounds_encoded:
+            _bounds_encoded[cache_key] = _encode_payload(_json_response({"level": cache_key, "items": data}))
+        return _encoded_response(*_bounds_encoded[cache_key])
 
     return app
 
@@ -1334,7 +2222,7 @@ def main():
             sp = DATA_DIR / f"{y}.sample_sz.csv"
             if sp.exists():
                 engine.year_paths[y] = sp
-                engine.year_colmaps[y] = detect_cols(sp)
+                engine.year_colmaps.pop(y, None)  # re-detected lazily for the sample file
     if args.build:
         engine.ensure_built(YEARS)
         print("build complete")
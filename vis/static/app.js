@@ -821,9 +821,14 @@
       if (!root || !window.html2canvas) return;
       const scale = Math.max(1, Math.min(2, window.devicePixelRatio || 1));
       const canvas = await html2canvas(root, {backgroundColor: '#ffffff', scale});
-      const dataUrl = canvas.toDataURL('image/jpeg', 0.92);
       const fname = `${gid}-${label}.jpg`;
-      await fetch('/api/screenshot', {method:'POST', headers:{'Content-Type':'application/json'}, body: JSON.stringify({filename: fname, data: dataUrl})});
+      // upload the JPEG as a binary multipart part instead of a base64 data URL (~1/3 smaller, no decode on the server)
+      const blob = await new Promise(resolve => canvas.toBlob(resolve, 'image/jpeg', 0.92));
+      if (!blob) return;
+      const form = new FormData();
+      form.append('filename', fname);
+      form.append('image', blob, fname);
+      await fetch('/api/screenshot', {method:'POST', body: form});
     } catch (e) {
       console.warn('screenshot failed', e);
     }